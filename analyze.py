@@ -5,12 +5,43 @@ import argparse
 import csv
 import datetime
 import glob
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import queue
+import random
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Iterable, List, Pattern, Sequence, Tuple
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Pattern, Sequence, Set, Tuple, Union
 
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from stats import wilson_ci
+
+try:
+    import ahocorasick
+except ImportError:  # optional, only speeds up --prefilter
+    ahocorasick = None
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse  # type: ignore[no-redef]
 
 PATTERNS: Dict[str, Dict[str, str]] = {
     "c": {
@@ -286,7 +317,8 @@ EXTENSIONS: Dict[str, Tuple[str, ...]] = {
     "ruby": (".rb",),
 }
 
-# These are for the progress bar:
+# Matching source files per language in the full dataset. Progress totals come
+# from the Parquet metadata; these only weight benchmark.py's language mix.
 TOTALS = {
     "c": 14143113,
     "cpp": 7380520,
@@ -299,6 +331,57 @@ TOTALS = {
     "ruby": 4473331,
 }
 
+# Values of the github-code 'language' column for each scanned language.
+DATASET_LANGUAGES: Dict[str, Tuple[str, ...]] = {
+    "c": ("C",),
+    "cpp": ("C++",),
+    "csharp": ("C#",),
+    "go": ("GO",),
+    "java": ("Java",),
+    "javascript": ("JavaScript", "TypeScript"),
+    "php": ("PHP",),
+    "python": ("Python",),
+    "ruby": ("Ruby",),
+}
+
+LANGUAGE_COLUMN = "language"
+
+# Default size of the leading region scanned with --header-region.
+HEADER_REGION_BYTES: Dict[str, int] = {
+    "c": 8192,
+    "cpp": 8192,
+    "csharp": 4096,
+    "go": 4096,
+    "java": 8192,
+    "javascript": 8192,
+    "php": 8192,
+    "python": 8192,
+    "ruby": 4096,
+}
+
+# Lines that start the body of a file, after which no more imports are expected.
+# Languages without an entry (or without such a line) use the byte limit alone.
+HEADER_END_PATTERNS: Dict[str, str] = {
+    "go": r"(?m)^func\s",
+    "java": r"(?m)^(?:public\s+|final\s+|abstract\s+)*(?:class|interface|enum|record)\s",
+    "python": r"(?m)^(?:def|class|async\s+def)\s",
+}
+
+# Lines kept in the --import-index: imports, includes, using and require
+# lines and similar, whatever the pattern set. Lines with a match of the
+# current patterns are always kept as well.
+IMPORT_LINE_PATTERNS: Dict[str, str] = {
+    "c": r"^[ \t]*#[ \t]*include\b.*",
+    "cpp": r"^[ \t]*#[ \t]*include\b.*",
+    "csharp": r"^[ \t]*(?:global[ \t]+)?using\b.*",
+    "go": r"^[ \t]*(?:import\b.*|(?:[\w.]+[ \t]+)?[\"`].*)",
+    "java": r"^[ \t]*(?:import|package)\b.*|^.*\bClass\.forName\b.*",
+    "javascript": r"^[ \t]*(?:import|export)\b.*|^.*\brequire[ \t]*\(.*",
+    "php": r"^[ \t]*(?:use|require|require_once|include|include_once|namespace)\b.*",
+    "python": r"^[ \t]*(?:import|from)[ \t].*",
+    "ruby": r"^[ \t]*(?:require|require_relative|gem|load|autoload)\b.*",
+}
+
 ALIASES = {
     "c#": "csharp",
     "cs": "csharp",
@@ -319,16 +402,705 @@ ALIASES = {
 }
 
 
+ALL_LANGUAGES = "all"
+
+SCAN_COLUMNS = ["repo_name", "path", "content"]
+
+# A unit of parallel work: one row group of one Parquet file.
+ScanUnit = Tuple[str, int]
+
+
+# Literal runs shorter than this are not worth a substring test in the prefilter.
+MIN_PREFILTER_LITERAL = 3
+
+# A necessary condition for a regex to match, in terms of literal substrings:
+# ("lit", text), ("and", [conditions]) or ("or", [conditions]).
+LiteralCondition = Tuple[str, object]
+
+
+@dataclass
+class ScanOptions:
+    """Engine switches shared by the main process and --workers processes."""
+
+    prefilter: bool = False
+    output_format: str = "csv"
+    file_records: bool = False
+    header_region: bool = False
+    header_bytes: Optional[int] = None
+    profile: bool = False
+    match_cache: int = 0
+    match_cache_dir: Optional[str] = None
+    import_index: bool = False
+    engine: str = "python"
+    shard: Optional[Tuple[int, int]] = None
+    presence: bool = False
+    # --sample: results go to <language>.sample.* instead of the full results.
+    sample: bool = False
+
+
+def _literal_condition(items: Iterable[Tuple[object, object]]) -> Optional[LiteralCondition]:
+    """
+    Walk a parsed regex and return a literal condition that every match must
+    satisfy, or None when no useful literal is required.
+    """
+    parts: List[LiteralCondition] = []
+    run: List[str] = []
+
+    def close_run() -> None:
+        if len(run) >= MIN_PREFILTER_LITERAL:
+            parts.append(("lit", "".join(run)))
+        run.clear()
+
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        close_run()
+
+        cond: Optional[LiteralCondition] = None
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, _, sub = av
+            if not add_flags & re.IGNORECASE:
+                cond = _literal_condition(sub)
+        elif op is sre_parse.BRANCH:
+            branches = [_literal_condition(branch) for branch in av[1]]
+            if all(branch is not None for branch in branches):
+                cond = ("or", branches)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, _, sub = av
+            if low >= 1:
+                cond = _literal_condition(sub)
+        if cond is not None:
+            parts.append(cond)
+    close_run()
+
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else ("and", parts)
+
+
+def literal_condition(pattern: str) -> Optional[LiteralCondition]:
+    parsed = sre_parse.parse(pattern)
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+    return _literal_condition(parsed)
+
+
+def _condition_literals(cond: LiteralCondition) -> Set[str]:
+    kind, value = cond
+    if kind == "lit":
+        return {value}
+    return set().union(*(_condition_literals(child) for child in value))
+
+
+def _key_literals(cond: LiteralCondition, frequency: Dict[str, int]) -> Set[str]:
+    """
+    Pick a small set of literals at least one of which must occur for cond to
+    hold. For AND nodes the child whose literals are shared by the fewest
+    patterns wins, so e.g. a library name is preferred over '#include'.
+    """
+    kind, value = cond
+    if kind == "lit":
+        return {value}
+    if kind == "or":
+        return set().union(*(_key_literals(child, frequency) for child in value))
+    candidates = [_key_literals(child, frequency) for child in value]
+    return min(candidates, key=lambda keys: (max(frequency[lit] for lit in keys), len(keys), -min(map(len, keys))))
+
+
+def split_alternatives(pattern: str) -> List[str]:
+    """
+    Split a regex at its top-level '|' (outside groups and character classes).
+    Patterns with global inline flags are returned whole.
+    """
+    if re.match(r"\(\?[aiLmsux]+\)", pattern):
+        return [pattern]
+    branches: List[str] = []
+    depth = 0
+    in_class = False
+    start = 0
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\":
+            index += 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            if pattern[index + 1 : index + 2] == "^":
+                index += 1
+            if pattern[index + 1 : index + 2] == "]":
+                index += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            branches.append(pattern[start:index])
+            start = index + 1
+        index += 1
+    branches.append(pattern[start:])
+    return branches
+
+
+@dataclass
+class DistinctPattern:
+    """
+    One canonical regex, matched once per file for every method that uses it.
+    If gate is set, it is the key of a pattern whose alternatives include all
+    of ours: when that pattern has no hits in a file, neither has this one.
+    """
+
+    key: str
+    cre: Pattern[str]
+    methods: List[str]
+    gate: Optional[str] = None
+    # The pattern compiled for --engine bytes, and whether it gives the same
+    # matches as cre on any UTF-8 text (otherwise only on ASCII text).
+    bcre: Optional[Pattern[bytes]] = None
+    byte_safe: bool = False
+    # For --engine arrow: whether RE2 accepts the pattern, and whether its
+    # ASCII-only classes give the same counts as re on any text.
+    re2_supported: bool = False
+    re2_exact: bool = False
+
+
+def _byte_safe(items: Iterable[Tuple[object, object]]) -> bool:
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            if av >= 0x80:
+                return False
+        elif op is sre_parse.IN:
+            if any(kind is not sre_parse.LITERAL and kind is not sre_parse.RANGE for kind, _ in av):
+                return False
+            if any(value >= 0x80 for kind, value in av if kind is sre_parse.LITERAL):
+                return False
+            if any(value[1] >= 0x80 for kind, value in av if kind is sre_parse.RANGE):
+                return False
+        elif op is sre_parse.BRANCH:
+            if not all(_byte_safe(branch) for branch in av[1]):
+                return False
+        elif op is sre_parse.SUBPATTERN:
+            if av[1] or not _byte_safe(av[3]):
+                return False
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, sub = av
+            if len(sub) == 1 and _any_char(sub[0]) and low <= 1 and high is sre_parse.MAXREPEAT:
+                continue
+            if not _byte_safe(sub):
+                return False
+        elif op is sre_parse.AT:
+            if av not in (sre_parse.AT_BEGINNING, sre_parse.AT_END, sre_parse.AT_BEGINNING_STRING, sre_parse.AT_END_STRING):
+                return False
+        else:
+            return False
+    return True
+
+
+def _any_char(item: Tuple[object, object]) -> bool:
+    """'.', [^...] or a negated literal over ASCII, which match one character."""
+    op, av = item
+    if op is sre_parse.ANY:
+        return True
+    if op is sre_parse.NOT_LITERAL:
+        return av < 0x80
+    if op is sre_parse.IN and av and av[0][0] is sre_parse.NEGATE:
+        return _byte_safe([(sre_parse.IN, av[1:])])
+    return False
+
+
+def byte_safe(pattern: str) -> bool:
+    """
+    True when the bytes-compiled pattern finds the same matches in UTF-8 as the
+    str pattern does in the decoded text. Unicode-aware classes (\\s, \\w, \\b,
+    ...) and single '.' or [^...] steps only agree on text without
+    TEXT_ONLY_BYTES. Unbounded runs of the latter are safe, since UTF-8 bytes of
+    non-ASCII characters are all >= 0x80.
+    """
+    if not pattern.isascii():
+        return False
+    parsed = sre_parse.parse(pattern)
+    return not parsed.state.flags & (re.IGNORECASE | re.LOCALE) and _byte_safe(parsed)
+
+
+def re2_exact(pattern: str) -> bool:
+    """
+    True when RE2 counts the same matches as re on any text. RE2 works on code
+    points like re does, but its \\s, \\w, \\d and \\b only know ASCII (and its
+    \\s leaves out \\v), so patterns using them can disagree on RE2_INEXACT_TEXT.
+    """
+    parsed = sre_parse.parse(pattern)
+    if parsed.state.flags & (re.IGNORECASE | re.LOCALE):
+        return False
+
+    def walk(items: Iterable[Tuple[object, object]]) -> bool:
+        for op, av in items:
+            if op is sre_parse.IN and any(kind is sre_parse.CATEGORY for kind, _ in av):
+                return False
+            if op is sre_parse.AT and av in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                return False
+            if op is sre_parse.BRANCH and not all(walk(branch) for branch in av[1]):
+                return False
+            if op is sre_parse.SUBPATTERN and (av[1] or not walk(av[3])):
+                return False
+            if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and not walk(av[2]):
+                return False
+        return True
+
+    return walk(parsed)
+
+
+def classify_re2(distinct_patterns: Sequence[DistinctPattern]) -> None:
+    for entry in distinct_patterns:
+        try:
+            pc.count_substring_regex(pa.array([""]), pattern=entry.key)
+        except pa.ArrowInvalid:
+            continue
+        entry.re2_supported = True
+        entry.re2_exact = re2_exact(entry.key)
+
+
+def compile_distinct_patterns(compiled_patterns: Sequence[Tuple[str, Pattern[str]]]) -> List[DistinctPattern]:
+    """
+    Merge methods whose patterns have the same top-level alternatives (after
+    dropping repeated ones) and order the result so that every gate comes
+    before the patterns it gates. Hit counts are the same as matching every
+    method's own pattern.
+    """
+    by_key: Dict[str, DistinctPattern] = {}
+    branch_sets: Dict[str, Set[str]] = {}
+    for method, cre in compiled_patterns:
+        branches = list(dict.fromkeys(split_alternatives(cre.pattern)))
+        key = "|".join(branches)
+        entry = by_key.get(key)
+        if entry is None:
+            entry = by_key[key] = DistinctPattern(key, cre if key == cre.pattern else re.compile(key), [])
+            branch_sets[key] = set(branches)
+        entry.methods.append(method)
+
+    distinct = sorted(by_key.values(), key=lambda entry: -len(branch_sets[entry.key]))
+    for entry in distinct:
+        if entry.key.isascii():
+            entry.bcre = re.compile(entry.key.encode("ascii"))
+            entry.byte_safe = byte_safe(entry.key)
+    for index, entry in enumerate(distinct):
+        supersets = [other for other in distinct[:index] if branch_sets[entry.key] < branch_sets[other.key]]
+        if supersets:
+            entry.gate = min(supersets, key=lambda other: len(branch_sets[other.key])).key
+    return distinct
+
+
+class LiteralPrefilter:
+    """
+    Literal gate in front of a language's regex set. Files containing none of
+    the key literals skip the regexes entirely; the remaining files only run
+    the regexes whose literal conditions hold. With pyahocorasick installed all
+    literals are found in one pass over the text, otherwise each key literal is
+    looked up with a substring search.
+    """
+
+    def __init__(self, distinct_patterns: Sequence[DistinctPattern]) -> None:
+        self.entries: List[Tuple[DistinctPattern, Optional[LiteralCondition]]] = [
+            (entry, literal_condition(entry.key)) for entry in distinct_patterns
+        ]
+        self.unconditioned = [entry for entry, cond in self.entries if cond is None]
+
+        frequency: Dict[str, int] = {}
+        for _, cond in self.entries:
+            if cond is not None:
+                for lit in _condition_literals(cond):
+                    frequency[lit] = frequency.get(lit, 0) + 1
+
+        keys: Set[str] = set()
+        for _, cond in self.entries:
+            if cond is not None:
+                keys |= _key_literals(cond, frequency)
+        self.keys = sorted(keys, key=lambda lit: (-len(lit), lit))
+        # Regexes search a memoryview in place, where `in` would need a bytes copy of the file.
+        self.byte_keys = re.compile(b"|".join(re.escape(lit.encode("utf-8")) for lit in self.keys)) if self.keys else None
+        self.byte_literals = {lit: re.compile(re.escape(lit.encode("utf-8"))) for lit in frequency}
+
+        self.automaton = None
+        if ahocorasick is not None and frequency:
+            self.automaton = ahocorasick.Automaton()
+            for lit in frequency:
+                self.automaton.add_word(lit, lit)
+            self.automaton.make_automaton()
+
+    @staticmethod
+    def _holds(cond: LiteralCondition, contains: Callable[[str], bool], seen: Dict[str, bool]) -> bool:
+        kind, value = cond
+        if kind == "lit":
+            present = seen.get(value)
+            if present is None:
+                present = seen[value] = contains(value)
+            return present
+        if kind == "and":
+            return all(LiteralPrefilter._holds(child, contains, seen) for child in value)
+        return any(LiteralPrefilter._holds(child, contains, seen) for child in value)
+
+    def candidates(self, text: str) -> List[DistinctPattern]:
+        if self.automaton is not None:
+            found = {lit for _, lit in self.automaton.iter(text)}
+            if not found:
+                return self.unconditioned
+            return [entry for entry, cond in self.entries if cond is None or self._holds_in(cond, found)]
+
+        if not any(lit in text for lit in self.keys):
+            return self.unconditioned
+        seen: Dict[str, bool] = {}
+        return [entry for entry, cond in self.entries if cond is None or self._holds(cond, text.__contains__, seen)]
+
+    def candidates_bytes(self, data: Union[bytes, memoryview]) -> List[DistinctPattern]:
+        """candidates() for UTF-8 content, used by --engine bytes without copying the buffer."""
+        if self.byte_keys is None or self.byte_keys.search(data) is None:
+            return self.unconditioned
+        seen: Dict[str, bool] = {}
+
+        def contains(lit: str) -> bool:
+            return self.byte_literals[lit].search(data) is not None
+
+        return [entry for entry, cond in self.entries if cond is None or self._holds(cond, contains, seen)]
+
+    @staticmethod
+    def _holds_in(cond: LiteralCondition, found: Set[str]) -> bool:
+        kind, value = cond
+        if kind == "lit":
+            return value in found
+        if kind == "and":
+            return all(LiteralPrefilter._holds_in(child, found) for child in value)
+        return any(LiteralPrefilter._holds_in(child, found) for child in value)
+
+
+# Files kept in the --profile-patterns "slowest files" list.
+PROFILE_SLOWEST_FILES = 20
+
+
+class PatternProfile:
+    """
+    Match cost per method for --profile-patterns: seconds spent, files the
+    regex ran on, files it matched and total hits, plus the files that took
+    longest to match overall.
+    """
+
+    def __init__(self, distinct_patterns: Sequence[DistinctPattern], slowest: int = PROFILE_SLOWEST_FILES) -> None:
+        self.labels = {entry.key: ", ".join(entry.methods) for entry in distinct_patterns}
+        self.seconds = {key: 0.0 for key in self.labels}
+        self.tested = {key: 0 for key in self.labels}
+        self.gated = {key: 0 for key in self.labels}
+        self.files_hit = {key: 0 for key in self.labels}
+        self.hits = {key: 0 for key in self.labels}
+        self.prefilter_seconds = 0.0
+        self.files = 0
+        self.slowest_limit = slowest
+        # Min-heap of (seconds, repo_name, path, chars, costliest method).
+        self.slowest: List[Tuple[float, str, str, int, str]] = []
+
+    def add_file(self, seconds: float, repo_name: str, path_value: str, chars: int, costliest: str) -> None:
+        self.files += 1
+        self._keep_slowest((seconds, repo_name, path_value, chars, costliest))
+
+    def _keep_slowest(self, entry: Tuple[float, str, str, int, str]) -> None:
+        seconds = entry[0]
+        if len(self.slowest) < self.slowest_limit:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other: "PatternProfile") -> None:
+        for key in self.seconds:
+            self.seconds[key] += other.seconds[key]
+            self.tested[key] += other.tested[key]
+            self.gated[key] += other.gated[key]
+            self.files_hit[key] += other.files_hit[key]
+            self.hits[key] += other.hits[key]
+        self.prefilter_seconds += other.prefilter_seconds
+        self.files += other.files
+        for entry in other.slowest:
+            self._keep_slowest(entry)
+
+    def report(self, language: str) -> List[str]:
+        """The report lines, most expensive method first."""
+        total = sum(self.seconds.values()) + self.prefilter_seconds
+        lines = [f"== {language}: {self.files:,} files, {total:.2f}s matching =="]
+        lines.append(
+            f"{'method':<32} {'seconds':>9} {'share':>6} {'tested':>10} {'gated':>10} {'files hit':>10} "
+            f"{'hits':>10} {'us/file':>8}  pattern"
+        )
+        for key in sorted(self.seconds, key=lambda key: -self.seconds[key]):
+            seconds = self.seconds[key]
+            tested = self.tested[key]
+            share = seconds / total if total else 0.0
+            per_file = seconds / tested * 1e6 if tested else 0.0
+            pattern = key if len(key) <= 60 else key[:57] + "..."
+            lines.append(
+                f"{self.labels[key]:<32} {seconds:>9.2f} {share:>6.1%} {tested:>10,} {self.gated[key]:>10,} "
+                f"{self.files_hit[key]:>10,} {self.hits[key]:>10,} {per_file:>8.1f}  {pattern}"
+            )
+        if self.prefilter_seconds:
+            share = self.prefilter_seconds / total if total else 0.0
+            lines.append(f"{'(prefilter)':<32} {self.prefilter_seconds:>9.2f} {share:>6.1%}")
+
+        lines.append("")
+        lines.append(f"Slowest {len(self.slowest)} files:")
+        for seconds, repo_name, path_value, chars, costliest in sorted(self.slowest, reverse=True):
+            lines.append(f"  {seconds * 1e3:>9.1f} ms {chars:>10,} chars  {costliest:<24} {repo_name}/{path_value}")
+        return lines
+
+
+# A file's match result: (method, hits) for every method with hits.
+FileHits = Tuple[Tuple[str, int], ...]
+
+# A --file-records row: repo, path, content hash, method mask and, with
+# --import-index, the file's import lines.
+FileRecord = Tuple[str, str, bytes, int, Optional[str]]
+
+
+# File content as a str, or as a memoryview of its UTF-8 bytes with --engine bytes.
+FileText = Union[str, memoryview]
+
+
+def content_hash(text: FileText) -> bytes:
+    data = text.encode("utf-8", "surrogatepass") if isinstance(text, str) else text
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def pattern_fingerprint(language: str) -> str:
+    """Changes whenever the language's method names or patterns change."""
+    payload = json.dumps([language, list(PATTERNS[language].items())]).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+class MatchCache:
+    """
+    Bounded LRU map from the content hash of a file (or its header region) to
+    its match result for one language's pattern set. Persisted caches are
+    stored as <language>-<pattern fingerprint>.parquet, so changing PATTERNS
+    starts a new cache instead of reusing stale results.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.entries: "OrderedDict[bytes, FileHits]" = OrderedDict()
+        self.hits = 0
+        self.lookups = 0
+        # Entries added since the last take_new(), kept only when a --workers
+        # process has to send them back for persisting.
+        self.new: Optional[List[Tuple[bytes, FileHits]]] = None
+
+    def get(self, key: bytes) -> Optional[FileHits]:
+        self.lookups += 1
+        found = self.entries.get(key)
+        if found is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return found
+
+    def put(self, key: bytes, value: FileHits) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        if self.new is not None:
+            self.new.append((key, value))
+
+    def take_new(self) -> List[Tuple[bytes, FileHits]]:
+        new, self.new = self.new or [], []
+        return new
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    @staticmethod
+    def path(directory: str, language: str) -> str:
+        return os.path.join(directory, f"{language}-{pattern_fingerprint(language)}.parquet")
+
+    def load(self, path: str, method_names: Sequence[str]) -> None:
+        """Read a saved cache, keeping its most recently used entries."""
+        if not os.path.exists(path):
+            return
+        table = pq.read_table(path)
+        start = max(table.num_rows - self.capacity, 0)
+        columns = table.slice(start).to_pydict()
+        for key, methods, counts in zip(columns["key"], columns["methods"], columns["hits"]):
+            self.entries[key] = tuple((method_names[index], count) for index, count in zip(methods, counts))
+
+    def save(self, path: str, method_names: Sequence[str]) -> None:
+        """Write the cache in LRU order (oldest first) via a temp file."""
+        index = {method: position for position, method in enumerate(method_names)}
+        table = pa.table(
+            {
+                "key": pa.array(list(self.entries), pa.binary(16)),
+                "methods": pa.array(
+                    [[index[method] for method, _ in value] for value in self.entries.values()], pa.list_(pa.uint16())
+                ),
+                "hits": pa.array(
+                    [[count for _, count in value] for value in self.entries.values()], pa.list_(pa.uint32())
+                ),
+            }
+        )
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+
+
+@dataclass
+class LanguageScan:
+    """Per-language state for one pass over the dataset."""
+
+    language: str
+    compiled_patterns: List[Tuple[str, Pattern[str]]]
+    csv_file_path: str
+    distinct_patterns: List[DistinctPattern] = field(default_factory=list)
+    repo_info: Dict[str, Dict[str, object]] = field(default_factory=dict)
+    count: int = 0
+    prefilter: Optional[LiteralPrefilter] = None
+    spill_runs: int = 0
+    output_format: str = "csv"
+    output_parts: int = 0
+    file_records: Optional[List[FileRecord]] = None
+    file_record_parts: int = 0
+    method_bits: Dict[str, int] = field(default_factory=dict)
+    header_limit: Optional[int] = None
+    header_end: Optional[Pattern[str]] = None
+    profile: Optional[PatternProfile] = None
+    match_cache: Optional[MatchCache] = None
+    import_lines: Optional[Pattern[str]] = None
+    shard: Optional[Tuple[int, int]] = None
+    # --presence: the distinct patterns each buffered repo has not matched yet.
+    residual: Optional[Dict[str, List[DistinctPattern]]] = None
+    sample: bool = False
+
+    @property
+    def method_names(self) -> List[str]:
+        return [name for name, _ in self.compiled_patterns]
+
+    @property
+    def stem(self) -> str:
+        """File name stem of every output: the language, plus the shard with --shard or .sample with --sample."""
+        if self.sample:
+            return f"{self.language}.sample"
+        if self.shard is None:
+            return self.language
+        return f"{self.language}.shard-{self.shard[0]}-of-{self.shard[1]}"
+
+    @property
+    def output_path(self) -> str:
+        return self.csv_file_path if self.output_format == "csv" else f"{self.stem}.parquet"
+
+    @property
+    def file_records_path(self) -> str:
+        return f"{self.stem}.files.parquet"
+
+    @property
+    def profile_path(self) -> str:
+        return f"{self.stem}.profile.txt"
+
+    @property
+    def patterns_path(self) -> str:
+        return f"{self.stem}.patterns.json"
+
+    @property
+    def manifest_path(self) -> str:
+        return f"{self.stem}.json"
+
+    @property
+    def sample_path(self) -> str:
+        return f"{self.stem}.json"
+
+
 def canonical_language(name: str) -> str:
     key = name.strip().lower()
     if key not in ALIASES:
-        valid = ", ".join(sorted(set(ALIASES)))
+        valid = ", ".join(sorted(set(ALIASES) | {ALL_LANGUAGES}))
         raise ValueError(f"Unsupported language '{name}'. Supported values: {valid}")
     return ALIASES[key]
 
 
-def compile_patterns(language: str) -> List[Tuple[str, Pattern[str]]]:
-    return [(pattern_name, re.compile(pattern)) for pattern_name, pattern in PATTERNS[language].items()]
+def resolve_languages(names: Sequence[str]) -> List[str]:
+    """
+    Canonicalize the requested languages, expanding 'all' and dropping duplicates
+    while keeping the order they were given in.
+    """
+    languages: List[str] = []
+    for name in names:
+        if name.strip().lower() == ALL_LANGUAGES:
+            candidates = list(PATTERNS)
+        else:
+            candidates = [canonical_language(name)]
+        for language in candidates:
+            if language not in languages:
+                languages.append(language)
+    return languages
+
+
+def compile_patterns(language: str, methods: Optional[Iterable[str]] = None) -> List[Tuple[str, Pattern[str]]]:
+    """The language's patterns, or only those of the given methods."""
+    selected = set(PATTERNS[language] if methods is None else methods)
+    return [
+        (pattern_name, re.compile(pattern))
+        for pattern_name, pattern in PATTERNS[language].items()
+        if pattern_name in selected
+    ]
+
+
+def make_language_scan(language: str, options: ScanOptions, methods: Optional[Iterable[str]] = None) -> LanguageScan:
+    compiled_patterns = compile_patterns(language, methods)
+    scan = LanguageScan(
+        language,
+        compiled_patterns,
+        f"{language}.csv",
+        distinct_patterns=compile_distinct_patterns(compiled_patterns),
+        output_format=options.output_format,
+        shard=options.shard,
+        sample=options.sample,
+    )
+    scan.csv_file_path = f"{scan.stem}.csv"
+    if options.prefilter:
+        scan.prefilter = LiteralPrefilter(scan.distinct_patterns)
+    if options.file_records:
+        scan.file_records = []
+        scan.method_bits = {method: 1 << index for index, (method, _) in enumerate(compiled_patterns)}
+    if options.header_region:
+        scan.header_limit = options.header_bytes or HEADER_REGION_BYTES[language]
+        if language in HEADER_END_PATTERNS:
+            scan.header_end = re.compile(HEADER_END_PATTERNS[language])
+    if options.profile:
+        scan.profile = PatternProfile(scan.distinct_patterns)
+    if options.import_index:
+        scan.import_lines = re.compile(IMPORT_LINE_PATTERNS[language], re.MULTILINE)
+    if options.engine == "arrow":
+        classify_re2(scan.distinct_patterns)
+    if options.presence:
+        scan.residual = {}
+    if options.match_cache > 0:
+        scan.match_cache = MatchCache(options.match_cache)
+        if options.match_cache_dir:
+            scan.match_cache.load(MatchCache.path(options.match_cache_dir, language), scan.method_names)
+    return scan
+
+
+def header_region(text: str, limit: int, end_pattern: Optional[Pattern[str]] = None) -> str:
+    """
+    The leading part of a file: the whole lines within the first `limit` bytes
+    of its UTF-8 encoding, cut earlier where end_pattern finds the start of the
+    body. A first line longer than `limit` is cut at `limit`.
+    """
+    # Characters never outnumber bytes, so the cut lies within the first `limit` characters.
+    head = text[:limit].encode("utf-8", "surrogatepass")
+    end = len(head[:limit].decode("utf-8", "ignore")) if len(head) > limit else limit
+    if len(text) > end:
+        newline = text.rfind("\n", 0, end + 1)
+        text = text[:newline] if newline >= 0 else text[:end]
+    if end_pattern is not None:
+        body = end_pattern.search(text)
+        if body is not None:
+            text = text[: body.start()]
+    return text
 
 
 def ensure_csv_header(csv_file_path: str, method_names: Iterable[str]) -> None:
@@ -343,12 +1115,20 @@ def ensure_csv_header(csv_file_path: str, method_names: Iterable[str]) -> None:
 def write_all_repo_data(csv_file_path: str, method_names: Sequence[str], repo_info: Dict[str, Dict[str, object]]) -> None:
     if not repo_info:
         return
+    write_repo_rows(csv_file_path, method_names, repo_info.items())
 
+
+def write_repo_rows(
+    csv_file_path: str,
+    method_names: Sequence[str],
+    rows: Iterable[Tuple[str, Dict[str, object]]],
+    keep_empty: bool = False,
+) -> None:
     fieldnames = ["repo_name", "num_files", "languages"] + list(method_names)
     with open(csv_file_path, mode="a", newline="", encoding="utf-8") as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        for repo_name, info in repo_info.items():
-            if any(int(info[method]) > 0 for method in method_names):
+        for repo_name, info in rows:
+            if keep_empty or any(int(info[method]) > 0 for method in method_names):
                 writer.writerow({
                     "repo_name": repo_name,
                     "num_files": info["num_files"],
@@ -357,6 +1137,279 @@ def write_all_repo_data(csv_file_path: str, method_names: Sequence[str], repo_in
                 })
 
 
+OUTPUT_FORMATS = ("csv", "parquet")
+
+# Rows per Parquet part file, for both repo results and per-file records.
+PARQUET_PART_ROWS = 500_000
+
+
+def parquet_part_path(directory: str, index: int) -> str:
+    return str(Path(directory) / f"part-{index:06d}.parquet")
+
+
+def count_parquet_parts(directory: str) -> int:
+    return len(list(Path(directory).glob("part-*.parquet")))
+
+
+def remove_parquet_parts(directory: str, keep: int) -> None:
+    """Delete the parts numbered keep and above."""
+    for path in Path(directory).glob("part-*.parquet"):
+        index = path.name[len("part-") : -len(".parquet")]
+        if index.isdigit() and int(index) >= keep:
+            path.unlink()
+
+
+def write_parquet_part(directory: str, index: int, table: pa.Table) -> None:
+    path = parquet_part_path(directory, index)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def repo_result_schema(method_names: Sequence[str]) -> pa.Schema:
+    return pa.schema(
+        [("repo_name", pa.string()), ("num_files", pa.int64()), ("languages", pa.string())]
+        + [(method, pa.int64()) for method in method_names]
+    )
+
+
+def file_record_schema(method_names: Sequence[str], with_lines: bool = False) -> pa.Schema:
+    """
+    One row per scanned file. Bit i of method_mask is set when method_names[i]
+    matched; the method order is kept in the schema metadata. With --import-index
+    a lines column holds the file's import lines.
+    """
+    fields = [
+        ("repo_name", pa.string()),
+        ("path", pa.string()),
+        ("content_hash", pa.binary(16)),
+        ("method_mask", pa.uint64()),
+    ]
+    if with_lines:
+        fields.append(("lines", pa.string()))
+    return pa.schema(fields, metadata={"methods": json.dumps(list(method_names))})
+
+
+def write_parquet_repo_rows(scan: LanguageScan, rows: Iterable[Tuple[str, Dict[str, object]]]) -> None:
+    method_names = scan.method_names
+    schema = repo_result_schema(method_names)
+    columns: Dict[str, List[object]] = {name: [] for name in schema.names}
+
+    def write_part() -> None:
+        write_parquet_part(scan.output_path, scan.output_parts, pa.table(columns, schema=schema))
+        scan.output_parts += 1
+        for values in columns.values():
+            values.clear()
+
+    for repo_name, info in rows:
+        if scan.shard is None and not any(int(info[method]) > 0 for method in method_names):
+            continue
+        columns["repo_name"].append(repo_name)
+        columns["num_files"].append(info["num_files"])
+        columns["languages"].append(", ".join(sorted(info["languages"])))
+        for method in method_names:
+            columns[method].append(info[method])
+        if len(columns["repo_name"]) >= PARQUET_PART_ROWS:
+            write_part()
+    if columns["repo_name"]:
+        write_part()
+
+
+def prepare_output(scan: LanguageScan) -> None:
+    """Create the result file or directory; like the CSV, existing results are appended to."""
+    if scan.output_format == "csv":
+        ensure_csv_header(scan.csv_file_path, scan.method_names)
+    else:
+        Path(scan.output_path).mkdir(parents=True, exist_ok=True)
+        scan.output_parts = count_parquet_parts(scan.output_path)
+    if scan.file_records is not None:
+        Path(scan.file_records_path).mkdir(parents=True, exist_ok=True)
+        scan.file_record_parts = count_parquet_parts(scan.file_records_path)
+
+
+def write_repo_output(scan: LanguageScan, rows: Iterable[Tuple[str, Dict[str, object]]]) -> None:
+    """
+    Append repo rows to the result. Repos without any hits are left out, except
+    in shard partials: their file counts are needed when merge_shards.py sums
+    a repo that has hits in another shard.
+    """
+    if scan.residual is not None:
+        rows = presence_rows(scan, rows)
+    if scan.output_format == "csv":
+        write_repo_rows(scan.csv_file_path, scan.method_names, rows, keep_empty=scan.shard is not None)
+    else:
+        write_parquet_repo_rows(scan, rows)
+
+
+def presence_rows(
+    scan: LanguageScan, rows: Iterable[Tuple[str, Dict[str, object]]]
+) -> Iterator[Tuple[str, Dict[str, object]]]:
+    """
+    --presence: method columns as 0/1. Merged partials (workers, spill runs)
+    can add up to more than 1.
+    """
+    for repo_name, info in rows:
+        yield repo_name, {**info, **{method: min(int(info[method]), 1) for method in scan.method_names}}
+
+
+def output_position(scan: LanguageScan) -> int:
+    """How far the results have been written: CSV bytes or Parquet parts."""
+    if scan.output_format == "csv":
+        fsync_file(scan.csv_file_path)
+        return os.path.getsize(scan.csv_file_path)
+    return scan.output_parts
+
+
+def truncate_output(scan: LanguageScan, position: int) -> None:
+    if scan.output_format == "csv":
+        if os.path.getsize(scan.csv_file_path) < position:
+            raise ValueError(f"{scan.csv_file_path} is shorter than recorded in the checkpoint")
+        with open(scan.csv_file_path, mode="r+b") as csv_file:
+            csv_file.truncate(position)
+    else:
+        remove_parquet_parts(scan.output_path, keep=position)
+        scan.output_parts = position
+
+
+def flush_file_records(scan: LanguageScan) -> None:
+    if not scan.file_records:
+        return
+    repo_names, paths, hashes, masks, lines = zip(*scan.file_records)
+    columns = [list(repo_names), list(paths), list(hashes), list(masks)]
+    if scan.import_lines is not None:
+        columns.append(list(lines))
+    table = pa.table(columns, schema=file_record_schema(scan.method_names, scan.import_lines is not None))
+    write_parquet_part(scan.file_records_path, scan.file_record_parts, table)
+    scan.file_record_parts += 1
+    scan.file_records.clear()
+
+
+def finish_output(scan: LanguageScan) -> None:
+    """Flush per-file records and make sure a Parquet result is readable even when empty."""
+    if scan.file_records is not None:
+        flush_file_records(scan)
+        if scan.file_record_parts == 0:
+            schema = file_record_schema(scan.method_names, scan.import_lines is not None)
+            write_parquet_part(scan.file_records_path, 0, schema.empty_table())
+            scan.file_record_parts = 1
+    if scan.output_format == "parquet" and scan.output_parts == 0:
+        write_parquet_part(scan.output_path, 0, repo_result_schema(scan.method_names).empty_table())
+        scan.output_parts = 1
+
+
+# Spill runs merged at once; more runs are first merged into intermediate runs.
+SPILL_MERGE_FAN_IN = 64
+
+
+def spill_run_path(spill_dir: str, stem: str, index: int) -> str:
+    """Spill run of the output with this stem, so shards sharing a --spill-dir keep their own runs."""
+    return str(Path(spill_dir) / f"{stem}.{index:06d}.run")
+
+
+def remove_spill_runs(spill_dir: str, stem: str, keep: int = 0) -> None:
+    """Delete the output's spill runs numbered keep and above."""
+    for path in Path(spill_dir).glob(f"{stem}.*.run"):
+        index = path.name[len(stem) + 1 : -len(".run")]
+        if index.isdigit() and int(index) >= keep:
+            path.unlink()
+
+
+def write_spill_run(path: str, method_names: Sequence[str], rows: Iterable[Tuple[str, Dict[str, object]]]) -> None:
+    """
+    Write repo aggregates sorted by repo_name as JSON lines of
+    [repo_name, num_files, languages, [method counts...]].
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as handle:
+        for repo_name, info in rows:
+            record = [repo_name, info["num_files"], sorted(info["languages"]), [info[method] for method in method_names]]
+            handle.write(json.dumps(record) + "\n")
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+
+
+def iter_spill_run(path: str, method_names: Sequence[str]) -> Iterator[Tuple[str, Dict[str, object]]]:
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            repo_name, num_files, languages, counts = json.loads(line)
+            yield repo_name, {"num_files": num_files, "languages": set(languages), **dict(zip(method_names, counts))}
+
+
+def merge_sorted_repo_rows(
+    runs: Sequence[Iterable[Tuple[str, Dict[str, object]]]]
+) -> Iterator[Tuple[str, Dict[str, object]]]:
+    """K-way merge of repo_name-sorted runs, folding equal repos into one row."""
+    current_name: Optional[str] = None
+    current: Dict[str, Dict[str, object]] = {}
+    for repo_name, info in heapq.merge(*runs, key=lambda row: row[0]):
+        if repo_name != current_name:
+            if current_name is not None:
+                yield current_name, current[current_name]
+            current_name = repo_name
+            current = {repo_name: info}
+        else:
+            merge_repo_info(current, {repo_name: info})
+    if current_name is not None:
+        yield current_name, current[current_name]
+
+
+def spill_repo_info(scan: LanguageScan, spill_dir: str) -> None:
+    write_spill_run(
+        spill_run_path(spill_dir, scan.stem, scan.spill_runs), scan.method_names, sorted(scan.repo_info.items())
+    )
+    scan.spill_runs += 1
+
+
+def flush_repo_info(scan: LanguageScan, spill_dir: Optional[str]) -> None:
+    """
+    Empty the repo buffer, either by appending its rows to the CSV or, with a
+    spill directory, into a sorted run that finish_language_scan merges.
+    """
+    if spill_dir is None:
+        write_repo_output(scan, scan.repo_info.items())
+    elif scan.repo_info:
+        spill_repo_info(scan, spill_dir)
+    scan.repo_info.clear()
+    if scan.residual is not None:
+        scan.residual.clear()
+
+
+def finish_language_scan(scan: LanguageScan, spill_dir: Optional[str]) -> None:
+    """
+    Write what is left. With a spill_dir, the output gets exactly one row per
+    repo, in repo_name order: all spill runs and the buffer are merged, or the
+    buffer alone is sorted when nothing was spilled.
+    """
+    if spill_dir is None:
+        write_repo_output(scan, scan.repo_info.items())
+        finish_output(scan)
+        return
+    if scan.spill_runs == 0:
+        write_repo_output(scan, sorted(scan.repo_info.items()))
+        finish_output(scan)
+        return
+
+    method_names = scan.method_names
+    paths = [spill_run_path(spill_dir, scan.stem, index) for index in range(scan.spill_runs)]
+    with tempfile.TemporaryDirectory(dir=spill_dir) as merge_dir:
+        level = 0
+        while len(paths) > SPILL_MERGE_FAN_IN:
+            merged_paths = []
+            for start in range(0, len(paths), SPILL_MERGE_FAN_IN):
+                merged_path = str(Path(merge_dir) / f"{level}.{start:06d}.run")
+                group = [iter_spill_run(path, method_names) for path in paths[start : start + SPILL_MERGE_FAN_IN]]
+                write_spill_run(merged_path, method_names, merge_sorted_repo_rows(group))
+                merged_paths.append(merged_path)
+            paths = merged_paths
+            level += 1
+
+        runs = [iter_spill_run(path, method_names) for path in paths]
+        runs.append(iter(sorted(scan.repo_info.items())))
+        write_repo_output(scan, merge_sorted_repo_rows(runs))
+    finish_output(scan)
+
+
 def iter_parquet_files(pattern: str) -> List[str]:
     return sorted([match for match in glob.glob(pattern) if Path(match).is_file()])
 
@@ -366,42 +1419,2219 @@ def path_matches_language(path_value: str, extensions: Tuple[str, ...]) -> bool:
     return lower.endswith(tuple(ext.lower() for ext in extensions))
 
 
+def build_extension_map(languages: Iterable[str]) -> Dict[str, str]:
+    extension_map: Dict[str, str] = {}
+    for language in languages:
+        for ext in EXTENSIONS[language]:
+            extension_map[ext.lower()] = language
+    return extension_map
+
+
+def language_for_path(path_value: str, extension_map: Dict[str, str]) -> Optional[str]:
+    """
+    Dispatch a file to a language by its extension. All EXTENSIONS entries are
+    single-dot suffixes, so the last dot decides.
+    """
+    lower = path_value.lower()
+    dot = lower.rfind(".")
+    if dot < 0:
+        return None
+    return extension_map.get(lower[dot:])
+
+
+def path_filter_expression(extension_map: Dict[str, str]) -> ds.Expression:
+    """
+    Arrow expression selecting the rows whose path ends with one of the mapped
+    extensions, so non-matching rows are dropped before their content is
+    converted to Python strings. language_for_path still makes the final call.
+    """
+    alternatives = "|".join(re.escape(ext.lstrip(".")) for ext in sorted(extension_map))
+    return pc.match_substring_regex(ds.field("path"), pattern=rf"\.(?:{alternatives})$", ignore_case=True)
+
+
+def dataset_language_values(languages: Iterable[str]) -> List[str]:
+    return sorted({value for language in languages for value in DATASET_LANGUAGES[language]})
+
+
+def scan_filter_expression(extension_map: Dict[str, str], language_values: Optional[Sequence[str]] = None) -> ds.Expression:
+    """
+    Row filter for the scanner. With language_values, rows must also carry one
+    of those values in the language column, which lets the Parquet reader skip
+    row groups whose statistics rule the values out.
+    """
+    expression = path_filter_expression(extension_map)
+    if language_values:
+        expression = ds.field(LANGUAGE_COLUMN).isin(list(language_values)) & expression
+    return expression
+
+
+def new_repo_entry(language: str, method_names: Iterable[str]) -> Dict[str, object]:
+    return {
+        "num_files": 0,
+        "languages": {language},
+        **{method: 0 for method in method_names},
+    }
+
+
+def scan_file(scan: LanguageScan, repo_name: str, path_value: str, text: FileText) -> None:
+    info = scan.repo_info.get(repo_name)
+    if info is None:
+        info = scan.repo_info[repo_name] = new_repo_entry(scan.language, scan.method_names)
+
+    info["num_files"] += 1
+    info["languages"].add(scan.language)
+
+    region = text if scan.header_limit is None else header_region(text, scan.header_limit, scan.header_end)
+    if scan.residual is not None:
+        scan_presence(scan, repo_name, info, region)
+        scan.count += 1
+        return
+
+    key = None
+    file_hits = None
+    if scan.match_cache is not None:
+        key = content_hash(region)
+        file_hits = scan.match_cache.get(key)
+    if file_hits is None:
+        if scan.profile is not None:
+            file_hits = match_profiled(scan, repo_name, path_value, region)
+        else:
+            file_hits = match_region(scan, region)
+        if key is not None:
+            scan.match_cache.put(key, file_hits)
+
+    for method, hits in file_hits:
+        info[method] += hits
+
+    if scan.file_records is not None:
+        lines = extract_index_lines(scan, region, file_hits) if scan.import_lines is not None else None
+        record_file(scan, repo_name, path_value, text, file_hits, key if region is text else None, lines)
+    scan.count += 1
+
+
+def scan_presence(scan: LanguageScan, repo_name: str, info: Dict[str, object], region: FileText) -> None:
+    """
+    --presence: match only the patterns the repo has not matched yet, and set
+    their methods to 1. Patterns drop out of the repo's residual set once all
+    their methods are present.
+    """
+    residual = scan.residual.get(repo_name, scan.distinct_patterns)
+    if not residual:
+        return
+    file_hits = match_presence(scan, residual, region)
+    if not file_hits:
+        return
+    for method, _ in file_hits:
+        info[method] = 1
+    scan.residual[repo_name] = [entry for entry in residual if any(info[method] == 0 for method in entry.methods)]
+
+
+def match_presence(scan: LanguageScan, residual: Sequence[DistinctPattern], region: FileText) -> FileHits:
+    """
+    Test the residual patterns with search() instead of counting every match.
+    A pattern is skipped when its gate was ruled out in this file; a gate that
+    is no longer residual was not tested, so it rules nothing out.
+    """
+    patterns = residual
+    candidate_keys: Optional[Set[str]] = None
+    if scan.prefilter is not None:
+        if isinstance(region, str):
+            candidates = scan.prefilter.candidates(region)
+        else:
+            candidates = scan.prefilter.candidates_bytes(region)
+        candidate_keys = {entry.key for entry in candidates}
+        patterns = [entry for entry in residual if entry.key in candidate_keys]
+
+    text = region if isinstance(region, str) else None
+    plain_bytes: Optional[bool] = None
+    file_hits: List[Tuple[str, int]] = []
+    missed: Set[str] = set()
+    for entry in patterns:
+        if entry.gate is not None and (
+            entry.gate in missed or (candidate_keys is not None and entry.gate not in candidate_keys)
+        ):
+            continue
+        if text is None and entry.byte_safe:
+            hit = entry.bcre.search(region) is not None
+        elif text is None:
+            if plain_bytes is None:
+                plain_bytes = TEXT_ONLY_BYTES.search(region) is None
+            if plain_bytes and entry.bcre is not None:
+                hit = entry.bcre.search(region) is not None
+            else:
+                text = str(region, "utf-8")
+                hit = entry.cre.search(text) is not None
+        else:
+            hit = entry.cre.search(text) is not None
+        if hit:
+            file_hits.extend((method, 1) for method in entry.methods)
+        else:
+            missed.add(entry.key)
+    return tuple(file_hits)
+
+
+def match_region(scan: LanguageScan, region: FileText) -> FileHits:
+    if not isinstance(region, str):
+        return match_bytes(scan, region)
+    patterns = scan.distinct_patterns if scan.prefilter is None else scan.prefilter.candidates(region)
+    file_hits: List[Tuple[str, int]] = []
+    found: Set[str] = set()
+    for entry in patterns:
+        if entry.gate is not None and entry.gate not in found:
+            continue
+        hits = len(entry.cre.findall(region))
+        if hits:
+            found.add(entry.key)
+            file_hits.extend((method, hits) for method in entry.methods)
+    return tuple(file_hits)
+
+
+# Bytes on which str and bytes patterns can disagree: anything outside ASCII,
+# and \x1c-\x1f, which str \s counts as whitespace but bytes \s does not.
+# Files with one need str matching for patterns that are not byte_safe.
+TEXT_ONLY_BYTES = re.compile(rb"[\x1c-\x1f\x80-\xff]")
+
+
+def match_bytes(scan: LanguageScan, region: memoryview) -> FileHits:
+    """
+    match_region on the UTF-8 bytes of a file. Patterns that are not byte_safe
+    are matched against the decoded text when the file is not pure ASCII.
+    """
+    if scan.prefilter is None:
+        patterns = scan.distinct_patterns
+    else:
+        patterns = scan.prefilter.candidates_bytes(region)
+    file_hits: List[Tuple[str, int]] = []
+    found: Set[str] = set()
+    text: Optional[str] = None
+    plain_bytes: Optional[bool] = None
+    for entry in patterns:
+        if entry.gate is not None and entry.gate not in found:
+            continue
+        if entry.byte_safe:
+            hits = len(entry.bcre.findall(region))
+        else:
+            if plain_bytes is None:
+                plain_bytes = TEXT_ONLY_BYTES.search(region) is None
+            if plain_bytes and entry.bcre is not None:
+                hits = len(entry.bcre.findall(region))
+            else:
+                if text is None:
+                    text = str(region, "utf-8")
+                hits = len(entry.cre.findall(text))
+        if hits:
+            found.add(entry.key)
+            file_hits.extend((method, hits) for method in entry.methods)
+    return tuple(file_hits)
+
+
+def match_profiled(scan: LanguageScan, repo_name: str, path_value: str, region: FileText) -> FileHits:
+    """match_region, timing every regex into scan.profile."""
+    profile = scan.profile
+    clock = time.perf_counter
+    file_start = clock()
+    text = region if isinstance(region, str) else None
+    plain_bytes = isinstance(region, memoryview) and TEXT_ONLY_BYTES.search(region) is None
+    patterns = scan.distinct_patterns
+    if scan.prefilter is not None:
+        if text is not None:
+            patterns = scan.prefilter.candidates(text)
+        else:
+            patterns = scan.prefilter.candidates_bytes(region)
+        profile.prefilter_seconds += clock() - file_start
+
+    file_hits: List[Tuple[str, int]] = []
+    found: Set[str] = set()
+    costliest, costliest_seconds = "", -1.0
+    for entry in patterns:
+        key = entry.key
+        if entry.gate is not None and entry.gate not in found:
+            profile.gated[key] += 1
+            continue
+        start = clock()
+        if text is None and (entry.byte_safe or plain_bytes) and entry.bcre is not None:
+            hits = len(entry.bcre.findall(region))
+        else:
+            if text is None:
+                text = str(region, "utf-8")
+            hits = len(entry.cre.findall(text))
+        seconds = clock() - start
+        profile.seconds[key] += seconds
+        profile.tested[key] += 1
+        if seconds > costliest_seconds:
+            costliest, costliest_seconds = profile.labels[key], seconds
+        if hits:
+            found.add(key)
+            profile.files_hit[key] += 1
+            profile.hits[key] += hits
+            file_hits.extend((method, hits) for method in entry.methods)
+    profile.add_file(clock() - file_start, repo_name, path_value, len(region), costliest or "(prefilter)")
+    return tuple(file_hits)
+
+
+def write_profile_report(scan: LanguageScan) -> None:
+    lines = scan.profile.report(scan.language)
+    if scan.match_cache is not None:
+        cache = scan.match_cache
+        lines.append("")
+        lines.append(f"Match cache hit rate {cache.hit_rate:.1%} ({cache.hits:,} of {cache.lookups:,} files, not timed).")
+    with open(scan.profile_path, "w", encoding="utf-8") as report:
+        report.write("\n".join(lines) + "\n")
+
+
+def record_file(
+    scan: LanguageScan,
+    repo_name: str,
+    path_value: str,
+    text: FileText,
+    file_hits: FileHits,
+    text_hash: Optional[bytes] = None,
+    lines: Optional[str] = None,
+) -> None:
+    mask = 0
+    for method, _ in file_hits:
+        mask |= scan.method_bits[method]
+    scan.file_records.append((repo_name, path_value, text_hash or content_hash(text), mask, lines))
+
+
+def extract_index_lines(scan: LanguageScan, region: FileText, file_hits: FileHits) -> str:
+    """
+    The import lines of a file plus every line that holds (part of) a match of
+    the current patterns, in file order. Matching the current patterns against
+    them gives the same counts as matching the whole file, unless a match
+    depends on the lines that were dropped.
+    """
+    if not isinstance(region, str):
+        region = str(region, "utf-8")
+    spans = [(match.start(), match.end()) for match in scan.import_lines.finditer(region)]
+    if file_hits:
+        matched = {method for method, _ in file_hits}
+        for entry in scan.distinct_patterns:
+            if matched.isdisjoint(entry.methods):
+                continue
+            for match in entry.cre.finditer(region):
+                end = region.find("\n", match.end())
+                spans.append((region.rfind("\n", 0, match.start()) + 1, len(region) if end < 0 else end))
+
+    lines: List[str] = []
+    covered = -1
+    for start, end in sorted(spans):
+        if end <= covered:
+            continue
+        lines.append(region[max(start, covered + 1) : end])
+        covered = end
+    return "\n".join(lines)
+
+
+def leading_literals(items: Iterable[Tuple[object, object]]) -> List[str]:
+    """
+    The literal texts a match can start with, after anchors; one per branch
+    of a leading alternation. An empty string means the start is not literal.
+    """
+    prefix = ""
+    for op, arg in items:
+        if op is sre_parse.AT and not prefix:
+            continue
+        if op is sre_parse.LITERAL:
+            prefix += chr(arg)
+            continue
+        if op is sre_parse.SUBPATTERN and not arg[1] and not arg[2]:
+            return [prefix + text for text in leading_literals(arg[3])]
+        if op is sre_parse.BRANCH:
+            return [prefix + text for branch in arg[1] for text in leading_literals(branch)]
+        break
+    return [prefix]
+
+
+def import_line_only(language: str, pattern: str) -> bool:
+    """
+    Whether every match of pattern starts like a line of IMPORT_LINE_PATTERNS
+    (e.g. `import x`, `#include <x>`), so the import index holds the lines it
+    can match. Patterns that may match anywhere (e.g. `\\bRails\\b`) are not.
+    """
+    import_line = re.compile(IMPORT_LINE_PATTERNS[language])
+    try:
+        texts = [text for branch in split_alternatives(pattern) for text in leading_literals(sre_parse.parse(branch))]
+    except re.error:
+        return False
+    return all(text and import_line.match(text) for text in texts)
+
+
+def write_result_patterns(scan: LanguageScan) -> None:
+    """Record the patterns the results were produced with, for --changed-only."""
+    write_json_atomic(scan.patterns_path, {"language": scan.language, "patterns": PATTERNS[scan.language]})
+
+
+def read_result_patterns(scan: LanguageScan) -> Dict[str, str]:
+    with open(scan.patterns_path, encoding="utf-8") as handle:
+        return json.load(handle)["patterns"]
+
+
+def iter_result_rows(
+    path: str, output_format: str, method_names: Sequence[str]
+) -> Iterator[Tuple[str, Dict[str, object]]]:
+    """The rows of a CSV or Parquet result as (repo_name, info), read incrementally."""
+    if output_format == "csv":
+        with open(path, newline="", encoding="utf-8") as csv_file:
+            rows: Iterable[Dict[str, object]] = csv.DictReader(csv_file)
+            yield from (result_row_info(row, method_names) for row in rows)
+        return
+    for batch in ds.dataset(path, format="parquet").to_batches():
+        yield from (result_row_info(row, method_names) for row in batch.to_pylist())
+
+
+def result_row_info(row: Dict[str, object], method_names: Sequence[str]) -> Tuple[str, Dict[str, object]]:
+    info: Dict[str, object] = {
+        "num_files": int(row["num_files"]),
+        "languages": set(str(row["languages"]).split(", ")),
+    }
+    info.update({method: int(row[method]) if row.get(method) not in (None, "") else 0 for method in method_names})
+    return str(row["repo_name"]), info
+
+
+def read_repo_results(scan: LanguageScan) -> Dict[str, Dict[str, object]]:
+    """
+    Existing results for the scan's language, summing partial rows left by
+    --flush-repos. Results missing, or only present in the other
+    --output-format, are an error rather than an empty result.
+    """
+    if not Path(scan.output_path).exists():
+        for output_format in OUTPUT_FORMATS:
+            other = f"{scan.stem}.{output_format}"
+            if output_format != scan.output_format and Path(other).exists():
+                raise ValueError(f"the existing results are {other}; pass --output-format {output_format}")
+        raise ValueError(f"{scan.output_path} not found; run --from-index once without --changed-only")
+    results: Dict[str, Dict[str, object]] = {}
+    for repo_name, info in iter_result_rows(scan.output_path, scan.output_format, scan.method_names):
+        merge_repo_info(results, {repo_name: info})
+    return results
+
+
+SHARD_MANIFEST_VERSION = 2
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse --shard i/N, with shards numbered 0 to N-1."""
+    index, sep, count = value.partition("/")
+    if not sep or not index.strip().isdigit() or not count.strip().isdigit():
+        raise ValueError(f"--shard must look like i/N, got '{value}'")
+    shard = (int(index), int(count))
+    if shard[1] < 1 or shard[0] >= shard[1]:
+        raise ValueError(f"--shard {value}: i must be between 0 and N-1")
+    return shard
+
+
+def shard_of(parquet_file: str, shards: int) -> int:
+    """
+    The shard a Parquet file belongs to, from a hash of its file name only, so
+    every machine agrees without seeing the same directory or file list.
+    """
+    digest = hashlib.blake2b(Path(parquet_file).name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+def shard_files(parquet_files: Sequence[str], shard: Tuple[int, int]) -> List[str]:
+    return [path for path in parquet_files if shard_of(path, shard[1]) == shard[0]]
+
+
+def write_shard_manifest(scan: LanguageScan, parquet_files: Sequence[str], config: Dict[str, object]) -> None:
+    """
+    Describe a finished shard result next to it: which shard of which split,
+    the patterns it was matched with and the files it covers. Written last,
+    so a manifest only exists for a complete partial.
+    """
+    write_json_atomic(
+        scan.manifest_path,
+        {
+            "version": SHARD_MANIFEST_VERSION,
+            "language": scan.language,
+            "shard": scan.shard[0],
+            "shards": scan.shard[1],
+            "fingerprint": pattern_fingerprint(scan.language),
+            "methods": scan.method_names,
+            "config": config,
+            "output": Path(scan.output_path).name,
+            "output_format": scan.output_format,
+            "files": scan.count,
+            "data_files": [Path(path).name for path in parquet_files],
+        },
+    )
+
+
+def read_shard_manifests(paths: Sequence[str]) -> Dict[str, List[Tuple[Path, Dict[str, object]]]]:
+    """Shard manifests per language, from manifest files or directories holding them."""
+    found: Dict[str, List[Tuple[Path, Dict[str, object]]]] = {}
+    for path in paths:
+        candidates = sorted(Path(path).glob("*.shard-*-of-*.json")) if Path(path).is_dir() else [Path(path)]
+        for candidate in candidates:
+            with open(candidate, encoding="utf-8") as handle:
+                manifest = json.load(handle)
+            if manifest.get("version") != SHARD_MANIFEST_VERSION:
+                raise ValueError(f"{candidate} is not a shard manifest of version {SHARD_MANIFEST_VERSION}")
+            found.setdefault(manifest["language"], []).append((candidate, manifest))
+    return found
+
+
+def check_shard_manifests(language: str, manifests: Sequence[Tuple[Path, Dict[str, object]]]) -> None:
+    """
+    Refuse to merge shards of different splits, patterns or settings, an
+    incomplete set, or shards whose data files overlap or belong elsewhere.
+    """
+    first_path, first = manifests[0]
+    for path, manifest in manifests[1:]:
+        for key in ("shards", "fingerprint", "methods", "config"):
+            if manifest[key] != first[key]:
+                raise ValueError(f"{language}: {path} and {first_path} differ in '{key}'")
+    if first["fingerprint"] != pattern_fingerprint(language):
+        raise ValueError(f"{language}: the shards were scanned with different patterns than the current ones")
+    indexes = [manifest["shard"] for _, manifest in manifests]
+    duplicates = sorted({index for index in indexes if indexes.count(index) > 1})
+    if duplicates:
+        raise ValueError(f"{language}: shard(s) {', '.join(map(str, duplicates))} given more than once")
+    missing = sorted(set(range(first["shards"])) - set(indexes))
+    if missing:
+        raise ValueError(f"{language}: missing shard(s) {', '.join(map(str, missing))} of {first['shards']}")
+    # Every file name has exactly one shard, so shards that pass this also cover disjoint files.
+    for path, manifest in manifests:
+        for name in manifest["data_files"]:
+            owner = shard_of(name, first["shards"])
+            if owner != manifest["shard"]:
+                raise ValueError(f"{language}: {path} covers {name}, which belongs to shard {owner}, not {manifest['shard']}")
+
+
+def merge_shard_results(
+    language: str,
+    manifests: Sequence[Tuple[Path, Dict[str, object]]],
+    output_format: str,
+    spill_dir: str,
+    flush_repos: int,
+) -> LanguageScan:
+    """
+    Combine a complete set of shard partials into <language>.csv (or .parquet)
+    in the current directory. Rows are folded through spill runs like
+    --spill-dir, so repos that span shards get one summed row and memory stays
+    bounded by flush_repos.
+    """
+    check_shard_manifests(language, manifests)
+    presence = bool(manifests[0][1]["config"].get("presence"))
+    scan = make_language_scan(language, ScanOptions(output_format=output_format, presence=presence))
+    remove_output(scan)
+    prepare_output(scan)
+    method_names = scan.method_names
+    Path(spill_dir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=spill_dir) as merge_dir:
+        for manifest_path, manifest in sorted(manifests, key=lambda item: item[1]["shard"]):
+            partial = str(manifest_path.parent / manifest["output"])
+            for repo_name, info in iter_result_rows(partial, manifest["output_format"], method_names):
+                merge_repo_info(scan.repo_info, {repo_name: info})
+                if len(scan.repo_info) >= flush_repos:
+                    flush_repo_info(scan, merge_dir)
+            scan.count += manifest["files"]
+        finish_language_scan(scan, merge_dir)
+    return scan
+
+
+def remove_output(scan: LanguageScan) -> None:
+    if scan.output_format == "csv":
+        Path(scan.csv_file_path).unlink(missing_ok=True)
+    elif Path(scan.output_path).exists():
+        shutil.rmtree(scan.output_path)
+
+
+def scan_import_index(scan: LanguageScan, index_path: str, batch_size: int) -> None:
+    dataset = ds.dataset(index_path, format="parquet")
+    if "lines" not in dataset.schema.names:
+        raise ValueError(f"{index_path} has no import lines; build it with --import-index")
+    for batch in dataset.to_batches(columns=["repo_name", "path", "lines"], batch_size=batch_size):
+        columns = batch.to_pydict()
+        for repo_name, path_value, lines in zip(columns["repo_name"], columns["path"], columns["lines"]):
+            scan_file(scan, repo_name, path_value, lines or "")
+
+
+def rescan_from_index(
+    language: str, options: ScanOptions, changed_only: bool, batch_size: int, import_lines: bool = False
+) -> Optional[LanguageScan]:
+    """
+    Rebuild a language's results from its --import-index. With changed_only,
+    only the methods whose pattern differs from the recorded one are matched
+    and merged into the existing results. Changed patterns that can match
+    outside import lines are refused unless import_lines accepts counting
+    them in the indexed lines only. Returns None when nothing changed.
+    """
+    out = make_language_scan(language, options)
+    methods = out.method_names
+    merged: Dict[str, Dict[str, object]] = {}
+    if changed_only and not Path(out.patterns_path).exists():
+        raise ValueError(f"{out.patterns_path} not found; run --from-index once without --changed-only")
+    if Path(out.patterns_path).exists():
+        previous = read_result_patterns(out)
+        changed = [method for method in methods if previous.get(method) != PATTERNS[language][method]]
+        # The index only holds import lines and the lines the old patterns matched.
+        unindexed = [method for method in changed if not import_line_only(language, PATTERNS[language][method])]
+        if unindexed and not import_lines:
+            exact = sum(import_line_only(language, pattern) for pattern in PATTERNS[language].values())
+            raise ValueError(
+                f"{language}: the changed pattern(s) of {', '.join(unindexed)} can match outside import lines, "
+                f"which {out.file_records_path} does not hold ({exact} of {len(PATTERNS[language])} {language} "
+                "patterns only match import lines); rescan the dataset with --import-index, or pass "
+                "--import-lines to count their matches in the indexed lines only"
+            )
+        if changed_only:
+            methods = changed
+            if not methods and set(previous) == set(PATTERNS[language]):
+                return None
+            merged = read_repo_results(out)
+
+    scan = make_language_scan(language, options, methods)
+    scan_import_index(scan, out.file_records_path, batch_size)
+    for repo_name, info in scan.repo_info.items():
+        row = merged.setdefault(repo_name, new_repo_entry(language, []))
+        row["num_files"] = info["num_files"]
+        row["languages"] |= info["languages"]
+    for repo_name, row in merged.items():
+        info = scan.repo_info.get(repo_name)
+        for method in out.method_names:
+            if method in methods:
+                row[method] = info[method] if info is not None else 0
+            else:
+                row.setdefault(method, 0)
+
+    remove_output(out)
+    prepare_output(out)
+    write_repo_output(out, merged.items())
+    finish_output(out)
+    write_result_patterns(out)
+    out.count = scan.count
+    return out
+
+
+def iter_source_files(batch: pa.RecordBatch, extension_map: Dict[str, str]) -> Iterator[Tuple[str, str, str, str]]:
+    """
+    Yield (language, repo_name, path, content) for every row of the batch whose
+    path belongs to one of the scanned languages.
+    """
+    columns = batch.to_pydict()
+    repo_names = columns["repo_name"]
+    paths = columns["path"]
+    contents = columns["content"]
+
+    for repo_name, path_value, content in zip(repo_names, paths, contents):
+        if repo_name is None or path_value is None or content is None:
+            continue
+        language = language_for_path(str(path_value), extension_map)
+        if language is None:
+            continue
+        yield language, str(repo_name), str(path_value), str(content)
+
+
+def iter_source_buffers(
+    batch: pa.RecordBatch, extension_map: Dict[str, str]
+) -> Iterator[Tuple[str, str, str, memoryview]]:
+    """
+    iter_source_files for --engine bytes: each content is a memoryview slice of
+    the batch's UTF-8 data buffer, so file bodies are never copied or decoded.
+    """
+    contents = content_views(batch.column("content"))
+    repo_names = batch.column("repo_name").to_pylist()
+    paths = batch.column("path").to_pylist()
+    for repo_name, path_value, content in zip(repo_names, paths, contents):
+        if repo_name is None or path_value is None or content is None:
+            continue
+        language = language_for_path(str(path_value), extension_map)
+        if language is None:
+            continue
+        yield language, str(repo_name), str(path_value), content
+
+
+def content_views(contents: pa.Array) -> Iterator[Optional[memoryview]]:
+    """Each string of the array as a memoryview of its UTF-8 bytes, None for nulls."""
+    if contents.type not in (pa.string(), pa.large_string()):
+        contents = contents.cast(pa.large_string())
+    _, offset_buffer, data_buffer = contents.buffers()
+    offsets = memoryview(offset_buffer).cast("i" if contents.type == pa.string() else "q")
+    data = memoryview(data_buffer) if data_buffer is not None else memoryview(b"")
+    base = contents.offset
+    valid = contents.is_valid().to_pylist() if contents.null_count else None
+    for index in range(len(contents)):
+        if valid is not None and not valid[index]:
+            yield None
+        else:
+            yield data[offsets[base + index] : offsets[base + index + 1]]
+
+
+# Characters on which RE2 and re classes can disagree: \v, \x1c-\x1f and
+# everything outside ASCII (RE2 syntax).
+RE2_INEXACT_TEXT = r"[^\x00-\x0a\x0c-\x1b\x20-\x7f]"
+
+
+def batch_languages(batch: pa.RecordBatch, extension_map: Dict[str, str]) -> Dict[str, pa.Array]:
+    """
+    For --engine arrow and the --sample index: a boolean row mask per
+    language, selecting the rows that language_for_path would dispatch to it.
+    Rows with a null in any of the batch's columns are left out.
+    """
+    valid = pc.is_valid(batch.column(0))
+    for column in batch.columns[1:]:
+        valid = pc.and_(valid, pc.is_valid(column))
+    lowered = pc.utf8_lower(batch.column("path"))
+    extension = pc.struct_field(pc.extract_regex(lowered, pattern=r"(?P<ext>\.[^.]*)$"), [0])
+    masks: Dict[str, pa.Array] = {}
+    for language in dict.fromkeys(extension_map.values()):
+        extensions = pa.array([ext for ext, mapped in extension_map.items() if mapped == language])
+        masks[language] = pc.fill_null(pc.and_(valid, pc.is_in(extension, value_set=extensions)), False)
+    return masks
+
+
+def count_pattern_arrow(entry: DistinctPattern, contents: pa.Array, state: Dict[str, object]) -> pa.Array:
+    """
+    Per-row hit counts of one pattern. RE2 counts rows in bulk; rows it could
+    count differently are recounted with re, as are all rows for patterns RE2
+    does not support. state caches the decoded texts and rows to recount.
+    """
+    if entry.re2_supported:
+        counts = pc.count_substring_regex(contents, pattern=entry.key)
+        if entry.re2_exact:
+            return counts
+        if "recount" not in state:
+            inexact = pc.match_substring_regex(contents, pattern=RE2_INEXACT_TEXT)
+            state["recount"] = pc.indices_nonzero(pc.fill_null(inexact, False)).to_pylist()
+        rows: List[int] = state["recount"]
+        if not rows:
+            return counts
+        values = counts.to_pylist()
+    else:
+        rows = list(range(len(contents)))
+        values = [0] * len(contents)
+    if "texts" not in state:
+        state["texts"] = contents.to_pylist()
+    texts: List[str] = state["texts"]
+    for row in rows:
+        values[row] = len(entry.cre.findall(texts[row]))
+    return pa.array(values, pa.int32())
+
+
+def scan_rows_arrow(scan: LanguageScan, rows: pa.RecordBatch) -> None:
+    """
+    Count every distinct pattern over a batch of one language's files and add
+    the per-repo sums, computed with an Arrow group-by, to scan.repo_info.
+    """
+    contents = rows.column("content")
+    state: Dict[str, object] = {}
+    counts: Dict[str, pa.Array] = {}
+    totals: Dict[str, int] = {}
+    zeros = None
+    for entry in scan.distinct_patterns:
+        if entry.gate is not None and not totals[entry.gate]:
+            if zeros is None:
+                zeros = pa.array([0] * rows.num_rows, pa.int32())
+            counts[entry.key] = zeros
+            totals[entry.key] = 0
+            if scan.profile is not None:
+                scan.profile.gated[entry.key] += rows.num_rows
+            continue
+        start = time.perf_counter()
+        counts[entry.key] = count_pattern_arrow(entry, contents, state)
+        totals[entry.key] = pc.sum(counts[entry.key]).as_py() or 0
+        if scan.profile is not None:
+            profile = scan.profile
+            profile.seconds[entry.key] += time.perf_counter() - start
+            profile.tested[entry.key] += rows.num_rows
+            profile.files_hit[entry.key] += pc.sum(pc.greater(counts[entry.key], 0)).as_py() or 0
+            profile.hits[entry.key] += totals[entry.key]
+    if scan.profile is not None:
+        scan.profile.files += rows.num_rows
+
+    columns = {"repo_name": rows.column("repo_name")}
+    hit_entries = [entry for entry in scan.distinct_patterns if totals[entry.key]]
+    for index, entry in enumerate(hit_entries):
+        columns[f"p{index}"] = counts[entry.key]
+    grouped = (
+        pa.table(columns)
+        .group_by("repo_name", use_threads=False)
+        .aggregate([("repo_name", "count")] + [(f"p{index}", "sum") for index in range(len(hit_entries))])
+    )
+    for row in grouped.to_pylist():
+        repo_name = row["repo_name"]
+        info = scan.repo_info.get(repo_name)
+        if info is None:
+            info = scan.repo_info[repo_name] = new_repo_entry(scan.language, scan.method_names)
+        info["num_files"] += row["repo_name_count"]
+        info["languages"].add(scan.language)
+        for index, entry in enumerate(hit_entries):
+            hits = row[f"p{index}_sum"]
+            if hits:
+                for method in entry.methods:
+                    info[method] += hits
+
+    if scan.file_records is not None:
+        record_rows_arrow(scan, rows, [(entry, counts[entry.key]) for entry in hit_entries])
+    scan.count += rows.num_rows
+
+
+def record_rows_arrow(
+    scan: LanguageScan, rows: pa.RecordBatch, hit_counts: Sequence[Tuple[DistinctPattern, pa.Array]]
+) -> None:
+    masks = pa.array([0] * rows.num_rows, pa.uint64())
+    for entry, counts in hit_counts:
+        bits = 0
+        for method in entry.methods:
+            bits |= scan.method_bits[method]
+        masks = pc.bit_wise_or(masks, pc.if_else(pc.greater(counts, 0), pa.scalar(bits, pa.uint64()), 0))
+    repo_names = rows.column("repo_name").to_pylist()
+    paths = rows.column("path").to_pylist()
+    for repo_name, path_value, content, mask in zip(
+        repo_names, paths, content_views(rows.column("content")), masks.to_pylist()
+    ):
+        scan.file_records.append((repo_name, path_value, content_hash(content), mask, None))
+
+
+def scan_batch_arrow(batch: pa.RecordBatch, extension_map: Dict[str, str], scans: Dict[str, LanguageScan]) -> Dict[str, int]:
+    """--engine arrow: scan a whole batch and return the files scanned per language."""
+    files: Dict[str, int] = {}
+    for language, mask in batch_languages(batch, extension_map).items():
+        rows = batch.filter(mask)
+        if rows.num_rows:
+            scan_rows_arrow(scans[language], rows)
+        files[language] = rows.num_rows
+    return files
+
+
+ENGINES = ("python", "bytes", "arrow")
+
+
+def source_file_reader(engine: str) -> Callable[[pa.RecordBatch, Dict[str, str]], Iterator[Tuple[str, str, str, FileText]]]:
+    """How batches are turned into files to scan_file for the given --engine."""
+    return iter_source_buffers if engine == "bytes" else iter_source_files
+
+
+def merge_repo_info(target: Dict[str, Dict[str, object]], partial: Dict[str, Dict[str, object]]) -> None:
+    """
+    Fold a partial per-repo aggregate into target. Counts are summed and
+    language sets are unioned; repos new to target keep the partial's order.
+    """
+    for repo_name, info in partial.items():
+        existing = target.get(repo_name)
+        if existing is None:
+            target[repo_name] = info
+            continue
+        for key, value in info.items():
+            if key == "languages":
+                existing["languages"] |= value
+            else:
+                existing[key] += value
+
+
+def row_group_may_contain(row_group: pq.RowGroupMetaData, column_index: int, values: Sequence[str]) -> bool:
+    statistics = row_group.column(column_index).statistics
+    if statistics is None or not statistics.has_min_max:
+        return True
+    low, high = statistics.min, statistics.max
+    if isinstance(low, bytes):
+        low, high = low.decode("utf-8", "replace"), high.decode("utf-8", "replace")
+    return any(low <= value <= high for value in values)
+
+
+def list_scan_units(parquet_files: Sequence[str], language_values: Optional[Sequence[str]] = None) -> List[ScanUnit]:
+    """
+    List the row groups to scan. With language_values, row groups whose
+    language column statistics exclude all of them are left out.
+    """
+    units: List[ScanUnit] = []
+    for path in parquet_files:
+        metadata = pq.read_metadata(path)
+        names = metadata.schema.names
+        column_index = names.index(LANGUAGE_COLUMN) if language_values and LANGUAGE_COLUMN in names else None
+        for row_group in range(metadata.num_row_groups):
+            if column_index is not None and not row_group_may_contain(
+                metadata.row_group(row_group), column_index, language_values
+            ):
+                continue
+            units.append((path, row_group))
+    return units
+
+
+def scan_unit_sizes(units: Sequence[ScanUnit]) -> List[Tuple[int, int]]:
+    """(rows, uncompressed bytes) of each unit, from the Parquet footers."""
+    metadata: Dict[str, pq.FileMetaData] = {}
+    sizes: List[Tuple[int, int]] = []
+    for path, row_group in units:
+        if path not in metadata:
+            metadata[path] = pq.read_metadata(path)
+        group = metadata[path].row_group(row_group)
+        sizes.append((group.num_rows, group.total_byte_size))
+    return sizes
+
+
+def iter_unit_batches(
+    unit: ScanUnit, batch_size: int, filter_expression: Optional[ds.Expression] = None
+) -> Iterator[pa.RecordBatch]:
+    path, row_group = unit
+    fragment = ds.ParquetFileFormat().make_fragment(
+        str(Path(path).resolve()), filesystem=pafs.LocalFileSystem(), row_groups=[row_group]
+    )
+    return fragment.to_batches(columns=SCAN_COLUMNS, filter=filter_expression, batch_size=batch_size)
+
+
+SAMPLE_INFO_VERSION = 1
+
+
+def index_repo_units(
+    units: Sequence[ScanUnit], extension_map: Dict[str, str], filter_expression: ds.Expression, batch_size: int
+) -> Dict[str, Dict[str, List[int]]]:
+    """
+    For --sample: per language, the indexes of the units holding each repo's
+    files. Only the repo_name and path columns are read, so the content
+    column (nearly all of the dataset) stays on disk.
+    """
+    index: Dict[str, Dict[str, List[int]]] = {language: {} for language in dict.fromkeys(extension_map.values())}
+    for unit_index, (path, row_group) in enumerate(units):
+        fragment = ds.ParquetFileFormat().make_fragment(
+            str(Path(path).resolve()), filesystem=pafs.LocalFileSystem(), row_groups=[row_group]
+        )
+        for batch in fragment.to_batches(columns=["repo_name", "path"], filter=filter_expression, batch_size=batch_size):
+            for language, mask in batch_languages(batch, extension_map).items():
+                repo_units = index[language]
+                for repo_name in pc.unique(pc.filter(batch.column("repo_name"), mask)).to_pylist():
+                    held = repo_units.setdefault(repo_name, [])
+                    if not held or held[-1] != unit_index:
+                        held.append(unit_index)
+    return index
+
+
+class RepoSample:
+    """
+    --sample: one language's repos in a random order, drawn in rounds, with
+    the running Wilson interval of each method's share of the sampled repos
+    that have any method (the proportion create_summaries.py reports).
+    """
+
+    def __init__(self, repo_units: Dict[str, List[int]], method_names: Sequence[str], seed: int) -> None:
+        self.repo_units = repo_units
+        self.order = sorted(repo_units)
+        random.Random(seed).shuffle(self.order)
+        self.method_names = list(method_names)
+        self.taken = 0
+        self.rounds = 0
+        self.with_any = 0
+        self.counts = {method: 0 for method in method_names}
+
+    @property
+    def population(self) -> int:
+        return len(self.order)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.taken >= self.population
+
+    def take(self, count: int) -> Set[str]:
+        drawn = self.order[self.taken : self.taken + count]
+        self.taken += len(drawn)
+        self.rounds += 1
+        return set(drawn)
+
+    def add(self, repo_info: Dict[str, Dict[str, object]]) -> None:
+        """Count the finished repos of a round; every file of each has been scanned."""
+        for info in repo_info.values():
+            found = [method for method in self.method_names if info[method]]
+            if found:
+                self.with_any += 1
+                for method in found:
+                    self.counts[method] += 1
+
+    def widest(self) -> Tuple[str, float]:
+        """The method with the widest interval, and that interval's half-width."""
+        widest = ("", 1.0)
+        for method in self.method_names:
+            low, high = wilson_ci(self.counts[method], self.with_any)
+            half = (high - low) / 2 if self.with_any else 1.0
+            if not widest[0] or half > widest[1]:
+                widest = (method, half)
+        return widest
+
+    def done(self, margin: float) -> bool:
+        return self.exhausted or (self.with_any > 0 and self.widest()[1] <= margin)
+
+    def next_round(self, margin: float, minimum: int) -> int:
+        """
+        Repos to draw next: as many as should bring the widest interval down to
+        margin if intervals shrink with the square root of the sample, between
+        minimum and the size of the sample so far.
+        """
+        if not self.with_any:
+            return max(minimum, self.taken)
+        half = self.widest()[1]
+        missing = self.with_any * ((half / margin) ** 2 - 1)
+        return max(minimum, min(math.ceil(missing * self.taken / self.with_any), self.taken))
+
+    def info(self, language: str, margin: float, seed: int) -> Dict[str, object]:
+        method, half = self.widest()
+        return {
+            "version": SAMPLE_INFO_VERSION,
+            "language": language,
+            "fingerprint": pattern_fingerprint(language),
+            "seed": seed,
+            "margin": margin,
+            "population_repos": self.population,
+            "sampled_repos": self.taken,
+            "repos_with_any_method": self.with_any,
+            "rounds": self.rounds,
+            "widest_method": method,
+            "widest_half_width": half,
+            "exhausted": self.exhausted,
+        }
+
+
+class SampleUnitCache:
+    """
+    --sample: the rows of every row group a round has read, kept in
+    LZ4-compressed Arrow files while later rounds may still draw repos from
+    them. A repo's files are spread over row groups, so the rounds keep
+    coming back to the same ones; this way each is read and decompressed
+    from the dataset only once.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        units: Sequence[ScanUnit],
+        repo_units: Iterable[Dict[str, List[int]]],
+        filter_expression: ds.Expression,
+        batch_size: int,
+    ) -> None:
+        self.directory = directory
+        self.units = units
+        self.filter_expression = filter_expression
+        self.batch_size = batch_size
+        self.cached: Dict[int, str] = {}
+        # Undrawn repos (per language) with files in each row group.
+        self.pending: Dict[int, int] = {}
+        for held in repo_units:
+            for unit_indexes in held.values():
+                for unit_index in unit_indexes:
+                    self.pending[unit_index] = self.pending.get(unit_index, 0) + 1
+
+    def take(self, repo_units: Dict[str, List[int]], drawn: Iterable[str]) -> None:
+        for repo_name in drawn:
+            for unit_index in repo_units[repo_name]:
+                self.pending[unit_index] -= 1
+
+    def batches(
+        self, unit_index: int, wanted: Sequence[str], on_read: Callable[[pa.RecordBatch], None]
+    ) -> Iterator[pa.RecordBatch]:
+        """The unit's rows of the wanted repos, from the cache or read (and cached) from the dataset."""
+        path = self.cached.get(unit_index)
+        if path is not None:
+            with pa.OSFile(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+            value_set = pa.array(wanted, type=table.schema.field("repo_name").type)
+            table = table.filter(pc.is_in(table.column("repo_name"), value_set=value_set))
+            yield from table.to_batches(max_chunksize=self.batch_size)
+            return
+
+        path = os.path.join(self.directory, f"unit-{unit_index:06d}.arrow")
+        writer: Optional[pa.ipc.RecordBatchFileWriter] = None
+        for batch in iter_unit_batches(self.units[unit_index], self.batch_size, self.filter_expression):
+            on_read(batch)
+            if self.pending.get(unit_index):
+                if writer is None:
+                    writer = pa.ipc.new_file(path, batch.schema, options=pa.ipc.IpcWriteOptions(compression="lz4"))
+                writer.write_batch(batch)
+            value_set = pa.array(wanted, type=batch.schema.field("repo_name").type)
+            yield batch.filter(pc.is_in(batch.column("repo_name"), value_set=value_set))
+        if writer is not None:
+            writer.close()
+            self.cached[unit_index] = path
+
+    def release(self) -> None:
+        """Drop the row groups no undrawn repo needs any more."""
+        for unit_index in [unit_index for unit_index in self.cached if not self.pending.get(unit_index)]:
+            os.remove(self.cached.pop(unit_index))
+
+
+CHECKPOINT_VERSION = 2
+
+
+def write_json_atomic(path: str, payload: Dict[str, object]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as handle:
+        json.dump(payload, handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+
+
+def fsync_file(path: str) -> None:
+    with open(path, mode="ab") as handle:
+        os.fsync(handle.fileno())
+
+
+def checkpoint_config(
+    languages: Sequence[str],
+    parquet_files: Sequence[str],
+    language_values: Optional[Sequence[str]],
+    spill_dir: Optional[str] = None,
+    options: Optional[ScanOptions] = None,
+) -> Dict[str, object]:
+    """The settings a checkpoint is only valid for."""
+    options = options or ScanOptions()
+    return {
+        "languages": list(languages),
+        "parquet_files": list(parquet_files),
+        "language_values": list(language_values) if language_values else None,
+        "spill_dir": spill_dir,
+        "output_format": options.output_format,
+        "file_records": options.file_records,
+        "header_region": options.header_region,
+        "header_bytes": options.header_bytes,
+        "import_index": options.import_index,
+        "shard": list(options.shard) if options.shard else None,
+        "presence": options.presence,
+    }
+
+
+def write_checkpoint(
+    path: str, config: Dict[str, object], units_done: int, files: int, scans: Dict[str, LanguageScan]
+) -> None:
+    """
+    Record the scan position together with the buffered repo_info and how far
+    every output has been written. Outputs are synced first, so anything the
+    checkpoint points at is on disk before the checkpoint replaces the old one.
+    """
+    languages: Dict[str, object] = {}
+    for language, scan in scans.items():
+        flush_file_records(scan)
+        languages[language] = {
+            "output_position": output_position(scan),
+            "file_record_parts": scan.file_record_parts,
+            "count": scan.count,
+            "spill_runs": scan.spill_runs,
+            "repo_info": {
+                repo_name: {**info, "languages": sorted(info["languages"])} for repo_name, info in scan.repo_info.items()
+            },
+        }
+    write_json_atomic(
+        path,
+        {
+            "version": CHECKPOINT_VERSION,
+            "config": config,
+            "units_done": units_done,
+            "files": files,
+            "languages": languages,
+        },
+    )
+
+
+def restore_checkpoint(path: str, config: Dict[str, object], scans: Dict[str, LanguageScan]) -> Tuple[int, int]:
+    """
+    Load a checkpoint into scans and cut every output back to the position
+    recorded with it, dropping rows flushed after the checkpoint was taken;
+    spill runs written after it are deleted likewise. Returns
+    (units_done, files).
+    """
+    with open(path, encoding="utf-8") as handle:
+        checkpoint = json.load(handle)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"{path}: unsupported checkpoint version {checkpoint.get('version')}")
+    if checkpoint["config"] != config:
+        raise ValueError(f"{path}: checkpoint was written for different languages, data files or filters")
+
+    for language, scan in scans.items():
+        state = checkpoint["languages"][language]
+        truncate_output(scan, state["output_position"])
+        if scan.file_records is not None:
+            scan.file_record_parts = state["file_record_parts"]
+            remove_parquet_parts(scan.file_records_path, keep=scan.file_record_parts)
+        scan.count = state["count"]
+        scan.spill_runs = state["spill_runs"]
+        if config["spill_dir"]:
+            remove_spill_runs(config["spill_dir"], scan.stem, keep=scan.spill_runs)
+        scan.repo_info = {
+            repo_name: {**info, "languages": set(info["languages"])} for repo_name, info in state["repo_info"].items()
+        }
+    return checkpoint["units_done"], checkpoint["files"]
+
+
+class Prefetcher:
+    """
+    Runs an iterator in a background thread and hands its items over through a
+    bounded queue. The producer blocks when the consumer falls `depth` items
+    behind, so reading ahead never holds more than that in memory. Exceptions
+    in the producer are re-raised in the consumer.
+    """
+
+    _END = object()
+
+    def __init__(self, source: Iterable[Any], depth: int) -> None:
+        self.queue: "queue.Queue[Tuple[object, Any]]" = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iter(source),), daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Tuple[object, Any]) -> bool:
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, source: Iterator[Any]) -> None:
+        try:
+            for item in source:
+                if not self._put((None, item)):
+                    return
+            self._put((self._END, None))
+        except BaseException as exc:  # handed to the consumer
+            self._put((self._END, exc))
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            marker, item = self.queue.get()
+            if marker is self._END:
+                if item is not None:
+                    raise item
+                return
+            yield item
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> "Prefetcher":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def iter_units_stream(
+    units: Sequence[ScanUnit],
+    batch_size: int,
+    filter_expression: Optional[ds.Expression],
+    unit_batch_size: Optional[Callable[[ScanUnit], int]] = None,
+) -> Iterator[Optional[pa.RecordBatch]]:
+    """
+    Batches of all units in order, with None marking the end of each unit.
+    unit_batch_size, when given, picks the batch size as each unit starts.
+    """
+    for unit in units:
+        size = unit_batch_size(unit) if unit_batch_size is not None else batch_size
+        yield from iter_unit_batches(unit, size, filter_expression)
+        yield None
+
+
+STREAM_DATASET = "codeparrot/github-code"
+
+# Hugging Face builders that stream local files, usable as a stand-in for the hub dataset.
+LOCAL_STREAM_BUILDERS = ("parquet", "json", "csv")
+
+
+def open_stream_rows(dataset_id: str, data_files: Optional[str] = None) -> Iterable[Dict[str, object]]:
+    """
+    Rows of a Hugging Face dataset in streaming mode, without downloading it.
+    With one of LOCAL_STREAM_BUILDERS, data_files are streamed from local disk.
+    """
+    try:
+        from datasets import load_dataset
+    except ImportError as exc:
+        raise RuntimeError("streaming needs the 'datasets' package (pip install datasets)") from exc
+    kwargs: Dict[str, object] = {"split": "train", "streaming": True}
+    if dataset_id in LOCAL_STREAM_BUILDERS and data_files:
+        kwargs["data_files"] = data_files
+    return load_dataset(dataset_id, **kwargs)
+
+
+def iter_stream_batches(
+    rows: Iterable[Dict[str, object]], batch_size: int, batch_bytes: Optional[int] = None
+) -> Iterator[pa.RecordBatch]:
+    """
+    Group streamed rows into record batches with the SCAN_COLUMNS schema, of at
+    most batch_size rows or about batch_bytes characters of content. The hub
+    version of github-code names the content column 'code'.
+    """
+    schema = pa.schema([(name, pa.string()) for name in SCAN_COLUMNS])
+    buffer: List[Dict[str, object]] = []
+    buffered = 0
+    for row in rows:
+        content = row["content"] if "content" in row else row.get("code")
+        buffer.append({"repo_name": row.get("repo_name"), "path": row.get("path"), "content": content})
+        buffered += len(content) if isinstance(content, str) else 0
+        if len(buffer) >= batch_size or (batch_bytes is not None and buffered >= batch_bytes):
+            yield pa.RecordBatch.from_pylist(buffer, schema=schema)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield pa.RecordBatch.from_pylist(buffer, schema=schema)
+
+
+# --memory-budget: share of the budget for batches being read, queued and
+# matched; each one is counted twice, for its Arrow buffers and the Python
+# strings made from them.
+BUDGET_BATCH_SHARE = 0.25
+# Repo state above this share of the budget is flushed early; batches shrink
+# while the total stays above it and grow back below BUDGET_LOW.
+BUDGET_HIGH = 0.8
+BUDGET_LOW = 0.5
+MIN_BATCH_BYTES = 1 << 20
+# Entries of each buffer whose size is measured to estimate the whole buffer.
+SIZE_SAMPLE_ENTRIES = 32
+
+
+def parse_byte_size(value: str) -> int:
+    """Parse sizes like 4G, 512M, 65536K or a plain byte count."""
+    text = value.strip().upper().rstrip("B")
+    scale = 1
+    if text and text[-1] in "KMGT":
+        scale = 1 << (10 * ("KMGT".index(text[-1]) + 1))
+        text = text[:-1]
+    try:
+        size = int(float(text) * scale)
+    except ValueError:
+        raise ValueError(f"invalid size '{value}'; use e.g. 4G, 512M or a byte count") from None
+    if size <= 0:
+        raise ValueError(f"size must be positive, got '{value}'")
+    return size
+
+
+def batch_rows_for_bytes(rows: int, size: int, batch_size: int, batch_bytes: int) -> int:
+    """Rows per batch so that a row group of `rows` rows and `size` bytes gives batches of about batch_bytes."""
+    if rows <= 0 or size <= 0:
+        return batch_size
+    return max(1, min(batch_size, batch_bytes * rows // size))
+
+
+def unit_batch_rows(unit: ScanUnit, batch_size: int, batch_bytes: int) -> int:
+    path, row_group = unit
+    group = pq.read_metadata(path).row_group(row_group)
+    return batch_rows_for_bytes(group.num_rows, group.total_byte_size, batch_size, batch_bytes)
+
+
+def split_batch(batch: pa.RecordBatch, batch_bytes: Optional[int]) -> Iterator[pa.RecordBatch]:
+    """
+    Zero-copy slices of a batch holding about batch_bytes of content each; a
+    single larger file gets a slice of its own.
+    """
+    if batch_bytes is None or batch.num_rows <= 1:
+        yield batch
+        return
+    lengths = pc.fill_null(pc.binary_length(batch.column("content")), 0).to_pylist()
+    if sum(lengths) <= batch_bytes:
+        yield batch
+        return
+    start = 0
+    size = 0
+    for index, length in enumerate(lengths):
+        if index > start and size + length > batch_bytes:
+            yield batch.slice(start, index - start)
+            start = index
+            size = 0
+        size += length
+    yield batch.slice(start)
+
+
+def deep_sizeof(value: object) -> int:
+    """sys.getsizeof of value plus everything held by its dicts, lists, tuples and sets."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item) for item in value)
+    return size
+
+
+def buffer_bytes(container: Union[Dict, List]) -> int:
+    """
+    Estimated memory of a buffer: the container itself plus its length times
+    the measured mean size of up to SIZE_SAMPLE_ENTRIES of its entries.
+    Shared objects (small ints, interned names) are counted per entry.
+    """
+    if not container:
+        return sys.getsizeof(container)
+    if isinstance(container, dict):
+        entries = [(key, value) for key, value in itertools.islice(container.items(), SIZE_SAMPLE_ENTRIES)]
+    else:
+        step = max(1, len(container) // SIZE_SAMPLE_ENTRIES)
+        entries = container[::step][:SIZE_SAMPLE_ENTRIES]
+    per_entry = sum(deep_sizeof(entry) for entry in entries) / len(entries)
+    return sys.getsizeof(container) + int(per_entry * len(container))
+
+
+def resident_bytes() -> Optional[int]:
+    """Resident set size of this process from /proc, or None where there is no /proc."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class MemoryBudget:
+    """
+    --memory-budget: sizes batches by content bytes and keeps an estimate of
+    the memory held by batches and per-language state (repo_info, buffered
+    file records, match caches), the latter measured on a sample of entries.
+    Near the budget it flushes the largest repo buffers early and shrinks
+    batches; with room again, batches grow back. The process's resident size
+    is tracked alongside for comparison.
+    """
+
+    def __init__(self, budget: int, prefetch: int, workers: int = 1) -> None:
+        self.budget = budget
+        self.in_flight = max(prefetch, 0) + max(workers, 1)
+        self.max_batch_bytes = max(MIN_BATCH_BYTES, int(budget * BUDGET_BATCH_SHARE / (2 * self.in_flight)))
+        self.batch_bytes = self.max_batch_bytes
+        self.estimate = 0
+        self.peak = 0
+        self.resident = resident_bytes()
+        self.peak_resident = self.resident
+        self.early_flushes = 0
+        self.shrinks = 0
+
+    def unit_batch_size(self, sizes: Dict[ScanUnit, Tuple[int, int]], batch_size: int) -> Callable[[ScanUnit], int]:
+        def size_for(unit: ScanUnit) -> int:
+            rows, size = sizes[unit]
+            return batch_rows_for_bytes(rows, size, batch_size, self.batch_bytes)
+
+        return size_for
+
+    def state_bytes(self, scan: LanguageScan) -> int:
+        size = buffer_bytes(scan.repo_info)
+        if scan.file_records is not None:
+            size += buffer_bytes(scan.file_records)
+        if scan.match_cache is not None:
+            size += buffer_bytes(scan.match_cache.entries)
+        return size
+
+    def check(self, scans: Dict[str, LanguageScan], batch: Optional[pa.RecordBatch], flush: Callable[[LanguageScan], None]) -> None:
+        """Update the estimate after a batch, flushing and resizing as needed."""
+        batches = 2 * max(self.batch_bytes * self.in_flight, batch.nbytes if batch is not None else 0)
+        state = {language: self.state_bytes(scan) for language, scan in scans.items()}
+        self.estimate = batches + sum(state.values())
+        self.peak = max(self.peak, self.estimate)
+        self.resident = resident_bytes()
+        if self.resident is not None:
+            self.peak_resident = max(self.peak_resident or 0, self.resident)
+        if self.estimate <= self.budget * BUDGET_HIGH:
+            if self.estimate < self.budget * BUDGET_LOW and self.batch_bytes < self.max_batch_bytes:
+                self.batch_bytes = min(self.max_batch_bytes, self.batch_bytes * 2)
+            return
+
+        for language in sorted(state, key=state.get, reverse=True):
+            scan = scans[language]
+            if not scan.repo_info and not scan.file_records:
+                continue
+            flush(scan)
+            if scan.file_records:
+                flush_file_records(scan)
+            self.early_flushes += 1
+            freed = state[language] - self.state_bytes(scan)
+            self.estimate -= freed
+            if self.estimate <= self.budget * BUDGET_LOW:
+                break
+        if self.estimate > self.budget * BUDGET_HIGH and self.batch_bytes > MIN_BATCH_BYTES:
+            self.batch_bytes = max(MIN_BATCH_BYTES, self.batch_bytes // 2)
+            self.shrinks += 1
+
+    def summary(self) -> str:
+        return (
+            f"peak estimate {self.peak / 2**20:,.0f} MB of {self.budget / 2**20:,.0f} MB, "
+            f"{self.early_flushes:,} early flushes, {self.shrinks:,} batch shrinks, "
+            f"batches now {self.batch_bytes / 2**20:,.1f} MB"
+            + (f", peak resident size {self.peak_resident / 2**20:,.0f} MB" if self.peak_resident is not None else "")
+        )
+
+
+TELEMETRY_FORMATS = ("jsonl", "prometheus")
+TELEMETRY_PREFIX = "d4_source_"
+
+
+class TelemetryWriter:
+    """
+    Writes metric snapshots to a file: one JSON object per line, or a
+    Prometheus textfile (for node_exporter's textfile collector) replaced on
+    every write.
+    """
+
+    def __init__(self, path: str, output_format: str, every: float) -> None:
+        self.path = path
+        self.output_format = output_format
+        self.every = every
+        self.last_write = time.monotonic()
+        if output_format == "jsonl":
+            open(path, mode="w", encoding="utf-8").close()
+
+    def due(self) -> bool:
+        return time.monotonic() - self.last_write >= self.every
+
+    def write(self, metrics: Dict[str, Optional[float]]) -> None:
+        self.last_write = time.monotonic()
+        if self.output_format == "jsonl":
+            record = {"time": datetime.datetime.now().isoformat(timespec="seconds"), **metrics}
+            with open(self.path, mode="a", encoding="utf-8") as handle:
+                handle.write(json.dumps(record) + "\n")
+            return
+        lines = []
+        for name, value in metrics.items():
+            if value is None:
+                continue
+            lines.append(f"# TYPE {TELEMETRY_PREFIX}{name} gauge")
+            lines.append(f"{TELEMETRY_PREFIX}{name} {value}")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as handle:
+            handle.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+class ProgressReporter:
+    """
+    Prints a STAT line every `every` matching source files and feeds the
+    optional TelemetryWriter. Rows and bytes read are counted per finished row
+    group against totals from the Parquet metadata (per batch with --stream,
+    which has no totals); `total` is an expected file count from --total.
+    Skipped files are rows read minus files scanned, taken only where both
+    cover the same rows.
+    """
+
+    def __init__(self, total: Optional[int], every: int, telemetry: Optional[TelemetryWriter] = None) -> None:
+        self.total = total
+        self.every = every
+        self.telemetry = telemetry
+        self.count = 0
+        self.rows = 0
+        self.bytes = 0
+        self.units = 0
+        self.rows_total: Optional[int] = None
+        self.bytes_total: Optional[int] = None
+        self.units_total: Optional[int] = None
+        self.start_count = 0
+        self.start_rows = 0
+        self.start_bytes = 0
+        # (rows, files) at the last point where the scanned files belong to exactly the rows read.
+        self.settled = (0, 0)
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.flush_seconds_last = 0.0
+        self.flush_seconds_max = 0.0
+        self.queue_depth: Optional[Callable[[], int]] = None
+        self.memory: Optional[MemoryBudget] = None
+        self.job_start_time = datetime.datetime.now()
+        self.loop_start_time = datetime.datetime.now()
+        self.clock_start = time.perf_counter()
+
+    def set_totals(self, sizes: Sequence[Tuple[int, int]], done: int = 0) -> None:
+        """Totals of all units, with the first `done` of them already scanned (--resume)."""
+        self.rows_total = sum(rows for rows, _ in sizes)
+        self.bytes_total = sum(size for _, size in sizes)
+        self.units_total = len(sizes)
+        self.rows = self.start_rows = sum(rows for rows, _ in sizes[:done])
+        self.bytes = self.start_bytes = sum(size for _, size in sizes[:done])
+        self.units = done
+        self.start_count = self.count
+        self.settled = (self.rows, self.count)
+
+    def read(self, rows: int, size: int, units: int = 0) -> None:
+        """
+        Count rows read: a finished unit after its files were scanned, or a
+        batch (--stream, --sample) before they are.
+        """
+        if not units:
+            self.settled = (self.rows, self.count)
+        self.rows += rows
+        self.bytes += size
+        self.units += units
+        if units:
+            self.settled = (self.rows, self.count)
+        self.maybe_write_telemetry()
+
+    def flushed(self, seconds: float) -> None:
+        self.flushes += 1
+        self.flush_seconds += seconds
+        self.flush_seconds_last = seconds
+        self.flush_seconds_max = max(self.flush_seconds_max, seconds)
+
+    def eta_seconds(self) -> Optional[float]:
+        elapsed = time.perf_counter() - self.clock_start
+        if self.rows_total and self.rows > self.start_rows:
+            return elapsed * (self.rows_total - self.rows) / (self.rows - self.start_rows)
+        if self.total and self.count > self.start_count:
+            return elapsed * max(self.total - self.count, 0) / (self.count - self.start_count)
+        return None
+
+    def metrics(self) -> Dict[str, Optional[float]]:
+        elapsed = time.perf_counter() - self.clock_start
+        eta = self.eta_seconds()
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "files_scanned": self.count,
+            "files_skipped": self.settled[0] - self.settled[1] if self.settled[0] else None,
+            "rows_read": self.rows,
+            "rows_total": self.rows_total,
+            "bytes_read": self.bytes,
+            "bytes_total": self.bytes_total,
+            "row_groups_done": self.units if self.units_total is not None else None,
+            "row_groups_total": self.units_total,
+            "files_per_second": round((self.count - self.start_count) / elapsed, 1) if elapsed else None,
+            "rows_per_second": round((self.rows - self.start_rows) / elapsed, 1) if elapsed else None,
+            "bytes_per_second": round((self.bytes - self.start_bytes) / elapsed, 1) if elapsed else None,
+            "flushes": self.flushes,
+            "flush_seconds_total": round(self.flush_seconds, 4),
+            "flush_seconds_last": round(self.flush_seconds_last, 4),
+            "flush_seconds_max": round(self.flush_seconds_max, 4),
+            "queue_depth": self.queue_depth() if self.queue_depth is not None else None,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "memory_estimate_bytes": self.memory.estimate if self.memory is not None else None,
+            "memory_resident_bytes": self.memory.resident if self.memory is not None else None,
+            "memory_budget_bytes": self.memory.budget if self.memory is not None else None,
+            "batch_target_bytes": self.memory.batch_bytes if self.memory is not None else None,
+        }
+
+    def maybe_write_telemetry(self) -> None:
+        if self.telemetry is not None and self.telemetry.due():
+            self.telemetry.write(self.metrics())
+
+    def finish(self) -> None:
+        self.settled = (self.rows, self.count)
+        if self.telemetry is not None:
+            self.telemetry.write(self.metrics())
+
+    def advance(self, files: int = 1) -> None:
+        previous = self.count
+        self.count += files
+        self.maybe_write_telemetry()
+        if self.every <= 0 or self.count // self.every == previous // self.every:
+            return
+
+        count = self.count
+        total = self.total
+        loop_end_time = datetime.datetime.now()
+        loop_duration = loop_end_time - self.loop_start_time
+        formatted_duration = f"{loop_duration.total_seconds():.2f}"
+        running = datetime.datetime.now() - self.job_start_time
+        eta = self.eta_seconds()
+        eta_text = f" ETA {datetime.timedelta(seconds=round(eta))}." if eta is not None else ""
+        if total:
+            left = f"{max(total - count, 0):,}"
+            per = round(100 - count / total * 100, 2)
+            print(f"STAT: {left} files left ({per}%).{eta_text} Running for {running}.", end=" ")
+        elif self.rows_total:
+            left = f"{self.rows_total - self.rows:,}"
+            per = round(100 - self.rows / self.rows_total * 100, 2)
+            print(
+                f"STAT: {count:,} matching source files scanned, {left} rows left ({per}%).{eta_text} "
+                f"Running for {running}.",
+                end=" ",
+            )
+        else:
+            print(f"STAT: {count:,} matching source files scanned. Running for {running}.", end=" ")
+        print(f"This loop took {formatted_duration} seconds.")
+        self.loop_start_time = datetime.datetime.now()
+
+
+# Per-process state for --workers, set up once by _init_worker.
+_WORKER_SCANS: Dict[str, LanguageScan] = {}
+_WORKER_EXTENSION_MAP: Dict[str, str] = {}
+_WORKER_BATCH_SIZE = 8192
+_WORKER_FILTER: Optional[ds.Expression] = None
+_WORKER_ENGINE = "python"
+
+
+def _init_worker(languages: List[str], options: ScanOptions, batch_size: int, filter_expression: ds.Expression) -> None:
+    global _WORKER_BATCH_SIZE, _WORKER_FILTER, _WORKER_ENGINE
+    _WORKER_SCANS.clear()
+    for language in languages:
+        scan = _WORKER_SCANS[language] = make_language_scan(language, options)
+        if scan.match_cache is not None and options.match_cache_dir:
+            scan.match_cache.new = []
+    _WORKER_EXTENSION_MAP.clear()
+    _WORKER_EXTENSION_MAP.update(build_extension_map(languages))
+    _WORKER_BATCH_SIZE = batch_size
+    _WORKER_FILTER = filter_expression
+    _WORKER_ENGINE = options.engine
+
+
+# What a worker returns per language: partial repo_info, files scanned,
+# per-file records (None unless --file-records), the pattern profile (None
+# unless --profile-patterns) and match cache (hits, lookups, new entries),
+# where new entries are only sent when the cache is persisted.
+CacheDelta = Tuple[int, int, List[Tuple[bytes, FileHits]]]
+UnitPartial = Tuple[
+    Dict[str, Dict[str, object]],
+    int,
+    Optional[List[FileRecord]],
+    Optional[PatternProfile],
+    Optional[CacheDelta],
+]
+
+
+def scan_unit_worker(unit: ScanUnit, batch_bytes: Optional[int] = None) -> Dict[str, UnitPartial]:
+    """
+    Scan one row group in a worker process and return, per language, the
+    partial repo_info and the number of files that went into it. batch_bytes
+    is the --memory-budget batch size at the time the unit was submitted.
+    """
+    for scan in _WORKER_SCANS.values():
+        scan.repo_info = {}
+        scan.count = 0
+        if scan.residual is not None:
+            scan.residual = {}
+        if scan.file_records is not None:
+            scan.file_records = []
+        if scan.profile is not None:
+            scan.profile = PatternProfile(scan.distinct_patterns)
+        if scan.match_cache is not None:
+            scan.match_cache.hits = scan.match_cache.lookups = 0
+
+    batch_size = _WORKER_BATCH_SIZE
+    if batch_bytes is not None:
+        batch_size = unit_batch_rows(unit, batch_size, batch_bytes)
+    for unit_batch in iter_unit_batches(unit, batch_size, _WORKER_FILTER):
+        for batch in split_batch(unit_batch, batch_bytes):
+            if _WORKER_ENGINE == "arrow":
+                scan_batch_arrow(batch, _WORKER_EXTENSION_MAP, _WORKER_SCANS)
+                continue
+            for language, repo_name, path_value, text in source_file_reader(_WORKER_ENGINE)(batch, _WORKER_EXTENSION_MAP):
+                scan_file(_WORKER_SCANS[language], repo_name, path_value, text)
+
+    return {
+        language: (scan.repo_info, scan.count, scan.file_records, scan.profile, worker_cache_delta(scan))
+        for language, scan in _WORKER_SCANS.items()
+    }
+
+
+def worker_cache_delta(scan: LanguageScan) -> Optional[CacheDelta]:
+    cache = scan.match_cache
+    if cache is None:
+        return None
+    return cache.hits, cache.lookups, cache.take_new()
+
+
+def merge_cache_delta(cache: MatchCache, delta: CacheDelta) -> None:
+    hits, lookups, new = delta
+    cache.hits += hits
+    cache.lookups += lookups
+    for key, value in new:
+        cache.put(key, value)
+
+
+def iter_parallel_partials(
+    units: Sequence[ScanUnit],
+    languages: List[str],
+    options: ScanOptions,
+    batch_size: int,
+    filter_expression: ds.Expression,
+    workers: int,
+    in_flight: Optional[Callable[[int], None]] = None,
+    batch_bytes: Optional[Callable[[], int]] = None,
+) -> Iterator[Dict[str, UnitPartial]]:
+    """
+    Run scan_unit_worker over a process pool and yield the partials in unit
+    order, so merging them is deterministic. At most 2 * workers units are in
+    flight, which bounds how many finished partials wait for a slow one.
+    in_flight is told how many units are queued or running before each yield.
+    batch_bytes gives the current --memory-budget batch size for each unit
+    submitted, so shrinking batches reaches the workers.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(languages, options, batch_size, filter_expression)) as pool:
+        pending: Deque[Future] = deque()
+        unit_iter = iter(units)
+        while True:
+            while len(pending) < 2 * workers:
+                unit = next(unit_iter, None)
+                if unit is None:
+                    break
+                pending.append(pool.submit(scan_unit_worker, unit, batch_bytes() if batch_bytes is not None else None))
+            if not pending:
+                return
+            if in_flight is not None:
+                in_flight(len(pending))
+            yield pending.popleft().result()
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Scan local github-code parquet files using d4-source regex patterns.")
-    parser.add_argument("language", help="Language name, e.g. ruby, python, c++")
+    parser.add_argument(
+        "languages",
+        nargs="+",
+        help="Language name(s), e.g. ruby, python, c++, or 'all' to produce every CSV from a single pass",
+    )
     parser.add_argument("--data-files", default="data/train-0*-of-01126.parquet", help="Glob for local parquet files")
+    parser.add_argument(
+        "--stream",
+        nargs="?",
+        const=STREAM_DATASET,
+        default=None,
+        metavar="DATASET",
+        help=f"Stream rows from a Hugging Face dataset instead of reading local parquet (default: {STREAM_DATASET}; "
+        f"{', '.join(LOCAL_STREAM_BUILDERS)} stream --data-files from local disk)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Batches to read ahead in a background thread while the current one is matched (0 = off)",
+    )
     parser.add_argument("--flush-repos", type=int, default=1000, help="Flush CSV after this many repos are buffered")
     parser.add_argument("--total", type=int, default=None, help="Expected total file count for progress reporting")
     parser.add_argument("--progress-every", type=int, default=10000, help="Print progress every N matching source files")
+    parser.add_argument(
+        "--telemetry",
+        default=None,
+        metavar="PATH",
+        help="Write throughput metrics (rows/s, bytes/s, files scanned and skipped, flush latency, queue depth, ETA) "
+        "to PATH during the scan",
+    )
+    parser.add_argument(
+        "--telemetry-format",
+        choices=TELEMETRY_FORMATS,
+        default="jsonl",
+        help="'jsonl' appends one JSON object per snapshot; 'prometheus' rewrites a textfile-collector file",
+    )
+    parser.add_argument("--telemetry-every", type=float, default=10.0, help="Seconds between telemetry snapshots")
     parser.add_argument("--batch-size", type=int, default=8192, help="Arrow batch size")
+    parser.add_argument(
+        "--presence",
+        action="store_true",
+        help="Record only whether each method occurs in a repo (0/1 columns, which is all create_summaries.py uses): "
+        "each file is searched only for the methods its repo has not matched yet",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        default=None,
+        metavar="SIZE",
+        help="Keep the estimated memory of batches and buffered results under SIZE (e.g. 4G): batches are sized "
+        "by content bytes (--batch-size becomes a row cap), and near the budget repos are flushed early and batches "
+        "shrink",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Write <language>.csv, or a <language>.parquet directory of zstd-compressed typed parts",
+    )
+    parser.add_argument(
+        "--file-records",
+        action="store_true",
+        help="Also write <language>.files.parquet with repo, path, content hash and matched-method bitmask per file",
+    )
+    parser.add_argument(
+        "--spill-dir",
+        default=None,
+        help="Instead of appending partial rows to the CSV on flush, spill sorted runs to this directory and "
+        "merge them at the end, so every repo gets exactly one row",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Scan Parquet row groups in N worker processes and merge their per-repo results "
+        "(with N > 1, requires --spill-dir)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="python",
+        help="'bytes' matches bytes-compiled patterns on slices of the Arrow buffers instead of Python strings; "
+        "'arrow' counts each pattern over whole batches with pyarrow's RE2 kernels and sums per repo with an "
+        "Arrow group-by (same results either way)",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Skip regexes whose required literals do not occur in the file (same results, less regex work)",
+    )
+    parser.add_argument(
+        "--header-region",
+        action="store_true",
+        help="Only match the leading import region of each file (see header_accuracy.py for the tradeoff)",
+    )
+    parser.add_argument(
+        "--header-bytes",
+        type=int,
+        default=None,
+        help="Size of the header region in UTF-8 bytes for every language (default: per-language HEADER_REGION_BYTES)",
+    )
+    parser.add_argument(
+        "--profile-patterns",
+        action="store_true",
+        help="Time every pattern and write a cost report to <language>.profile.txt (slows the scan down)",
+    )
+    parser.add_argument(
+        "--match-cache",
+        type=int,
+        default=0,
+        help="Remember the match results of up to N distinct file contents per language, so duplicate files "
+        "cost one hash (0 = off)",
+    )
+    parser.add_argument(
+        "--match-cache-dir",
+        default=None,
+        help="Load and save the --match-cache here, one file per language and pattern set",
+    )
+    parser.add_argument(
+        "--import-index",
+        action="store_true",
+        help="Also store each file's import lines (and lines matching the current patterns) in "
+        "<language>.files.parquet, for later runs with --from-index (implies --file-records)",
+    )
+    parser.add_argument(
+        "--from-index",
+        action="store_true",
+        help="Match the patterns against the import index in <language>.files.parquet instead of the dataset "
+        "and rewrite the results",
+    )
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="With --from-index, only match methods whose pattern changed since the last index run and merge "
+        "them into the existing results",
+    )
+    parser.add_argument(
+        "--import-lines",
+        action="store_true",
+        help="With --from-index, accept changed patterns that can match outside import lines and count only "
+        "their matches in the indexed lines (import lines plus lines the previous patterns matched)",
+    )
+    parser.add_argument(
+        "--language-filter",
+        action="store_true",
+        help=f"Also require the dataset's '{LANGUAGE_COLUMN}' column to match, skipping row groups whose "
+        "statistics exclude the scanned languages (falls back to extensions only if the column is missing)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Periodically save the scan position and buffered results to this file (removed on success)",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=float,
+        default=60.0,
+        help="Minimum seconds between checkpoints; they are taken between row groups (default: 60)",
+    )
+    parser.add_argument("--resume", action="store_true", help="Continue the run recorded in --checkpoint")
+    parser.add_argument(
+        "--shard",
+        default=None,
+        metavar="i/N",
+        help="Scan only shard i (0 to N-1) of the --data-files, chosen by a hash of each file name, and write "
+        "<language>.shard-i-of-N.* partials plus a manifest for merge_shards.py",
+    )
+    parser.add_argument(
+        "--sample",
+        nargs="?",
+        type=float,
+        const=0.5,
+        default=None,
+        metavar="PP",
+        help="Scan randomly drawn repos in rounds until every method's 95%% Wilson interval is within +/- PP "
+        "percentage points (default: 0.5), and write <language>.sample.json for create_summaries.py",
+    )
+    parser.add_argument(
+        "--sample-repos",
+        type=int,
+        default=1000,
+        help="Repos drawn per language in the first --sample round, and the least drawn in later ones",
+    )
+    parser.add_argument("--sample-seed", type=int, default=0, help="Seed for the order in which --sample draws repos")
     args = parser.parse_args()
 
+    if args.resume and not args.checkpoint:
+        print("Error: --resume requires --checkpoint", file=sys.stderr)
+        return 1
+    if args.checkpoint and not args.resume and Path(args.checkpoint).exists():
+        print(
+            f"Error: checkpoint {args.checkpoint} exists. Pass --resume to continue that run or delete it to start over.",
+            file=sys.stderr,
+        )
+        return 1
+
     try:
-        language = canonical_language(args.language)
+        languages = resolve_languages(args.languages)
     except ValueError as exc:
         print(f"Error: {exc}", file=sys.stderr)
         return 1
 
-    parquet_files = iter_parquet_files(args.data_files)
-    if not parquet_files:
-        print(f"Error: no parquet files matched: {args.data_files}", file=sys.stderr)
+    if args.changed_only and not args.from_index:
+        print("Error: --changed-only requires --from-index", file=sys.stderr)
+        return 1
+    if args.import_lines and not args.from_index:
+        print("Error: --import-lines requires --from-index", file=sys.stderr)
+        return 1
+    if args.from_index and (
+        args.stream
+        or args.workers > 1
+        or args.checkpoint
+        or args.file_records
+        or args.import_index
+        or args.header_region
+        or args.profile_patterns
+        or args.match_cache
+        or args.telemetry
+    ):
+        print(
+            "Error: --from-index cannot be combined with --stream, --workers, --checkpoint, --file-records, "
+            "--import-index, --header-region, --profile-patterns, --match-cache or --telemetry",
+            file=sys.stderr,
+        )
         return 1
 
-    compiled_patterns = compile_patterns(language)
-    extensions = EXTENSIONS[language]
-    csv_file_path = f"{language}.csv"
-    method_names = [name for name, _ in compiled_patterns]
-    ensure_csv_header(csv_file_path, method_names)
+    if args.engine == "bytes" and args.header_region:
+        print("Error: --engine bytes cannot be combined with --header-region", file=sys.stderr)
+        return 1
+    if args.engine == "arrow" and (args.header_region or args.prefilter or args.match_cache or args.import_index):
+        print(
+            "Error: --engine arrow cannot be combined with --header-region, --prefilter, --match-cache or --import-index",
+            file=sys.stderr,
+        )
+        return 1
 
-    total = args.total if args.total is not None else TOTALS.get(language)
-    repo_info: Dict[str, Dict[str, object]] = {}
-    count = 0
-    job_start_time = datetime.datetime.now()
-    loop_start_time = datetime.datetime.now()
+    if args.match_cache_dir and args.match_cache <= 0:
+        print("Error: --match-cache-dir requires --match-cache N", file=sys.stderr)
+        return 1
+
+    if args.stream and (args.workers > 1 or args.checkpoint or args.language_filter):
+        print("Error: --stream cannot be combined with --workers, --checkpoint or --language-filter", file=sys.stderr)
+        return 1
+
+    if args.workers > 1 and not args.spill_dir:
+        # Partials arrive per row group, so --flush-repos would cut repos at other points than a serial scan.
+        print(
+            "Error: --workers requires --spill-dir, so that every repo gets one row as in a serial scan",
+            file=sys.stderr,
+        )
+        return 1
+
+    if args.presence and (
+        args.from_index
+        or args.engine == "arrow"
+        or args.file_records
+        or args.import_index
+        or args.match_cache
+        or args.profile_patterns
+    ):
+        print(
+            "Error: --presence cannot be combined with --from-index, --engine arrow, --file-records, --import-index, "
+            "--match-cache or --profile-patterns",
+            file=sys.stderr,
+        )
+        return 1
+
+    sample_margin: Optional[float] = None
+    if args.sample is not None:
+        if (
+            args.stream
+            or args.from_index
+            or args.workers > 1
+            or args.checkpoint
+            or args.shard
+            or args.engine == "arrow"
+            or args.import_index
+            or args.memory_budget
+            or args.telemetry
+        ):
+            print(
+                "Error: --sample cannot be combined with --stream, --from-index, --workers, --checkpoint, --shard, "
+                "--engine arrow, --import-index, --memory-budget or --telemetry",
+                file=sys.stderr,
+            )
+            return 1
+        if not 0 < args.sample < 50 or args.sample_repos < 1:
+            print("Error: --sample must be between 0 and 50 and --sample-repos at least 1", file=sys.stderr)
+            return 1
+        sample_margin = args.sample / 100
+
+    budget: Optional[MemoryBudget] = None
+    if args.memory_budget:
+        if args.from_index:
+            print("Error: --memory-budget cannot be combined with --from-index", file=sys.stderr)
+            return 1
+        try:
+            budget_bytes = parse_byte_size(args.memory_budget)
+        except ValueError as exc:
+            print(f"Error: --memory-budget: {exc}", file=sys.stderr)
+            return 1
+        budget = MemoryBudget(budget_bytes, args.prefetch if args.workers <= 1 else 0, args.workers)
+        if 2 * MIN_BATCH_BYTES * budget.in_flight > budget_bytes * BUDGET_HIGH:
+            print(
+                f"Warning: --memory-budget {args.memory_budget} leaves no room beside the smallest batches; "
+                "repos will be flushed after every batch.",
+                file=sys.stderr,
+            )
+
+    shard: Optional[Tuple[int, int]] = None
+    if args.shard:
+        if args.stream or args.from_index or args.import_index:
+            print("Error: --shard cannot be combined with --stream, --from-index or --import-index", file=sys.stderr)
+            return 1
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as exc:
+            print(f"Error: {exc}", file=sys.stderr)
+            return 1
+
+    parquet_files: List[str] = []
+    if not args.stream and not args.from_index:
+        parquet_files = iter_parquet_files(args.data_files)
+        if not parquet_files:
+            print(f"Error: no parquet files matched: {args.data_files}", file=sys.stderr)
+            return 1
+        if shard is not None:
+            parquet_files = shard_files(parquet_files, shard)
+            print(f"INFO: shard {shard[0]}/{shard[1]} has {len(parquet_files):,} of the matched parquet files.")
+
+    options = ScanOptions(
+        prefilter=args.prefilter,
+        output_format=args.output_format,
+        file_records=args.file_records or args.import_index,
+        header_region=args.header_region,
+        header_bytes=args.header_bytes,
+        profile=args.profile_patterns,
+        match_cache=args.match_cache,
+        match_cache_dir=args.match_cache_dir,
+        import_index=args.import_index,
+        engine=args.engine,
+        shard=shard,
+        presence=args.presence,
+        sample=sample_margin is not None,
+    )
+    if args.from_index:
+        for language in languages:
+            try:
+                scan = rescan_from_index(language, options, args.changed_only, args.batch_size, args.import_lines)
+            except (OSError, ValueError) as exc:
+                print(f"Error: {exc}", file=sys.stderr)
+                return 1
+            if scan is None:
+                print(f"END: No {language} patterns changed since the last run.")
+            else:
+                print(f"END: Data has been rewritten to {scan.output_path} from the import index ({scan.count:,} files).")
+        return 0
+
+    if args.match_cache_dir:
+        Path(args.match_cache_dir).mkdir(parents=True, exist_ok=True)
+    scans: Dict[str, LanguageScan] = {}
+    for language in languages:
+        scan = make_language_scan(language, options)
+        if sample_margin is not None:
+            remove_output(scan)
+            Path(scan.sample_path).unlink(missing_ok=True)
+        elif args.checkpoint and not args.resume:
+            # A fresh checkpointed run starts from empty results, so a later --resume only ever cuts its own rows.
+            remove_output(scan)
+        if (args.import_index or (args.checkpoint and options.file_records)) and not args.resume:
+            # The index is rebuilt from scratch; appending would duplicate its records.
+            remove_parquet_parts(scan.file_records_path, keep=0)
+        prepare_output(scan)
+        scans[language] = scan
+    if args.spill_dir:
+        Path(args.spill_dir).mkdir(parents=True, exist_ok=True)
+        if not args.resume:
+            for scan in scans.values():
+                remove_spill_runs(args.spill_dir, scan.stem)
+    extension_map = build_extension_map(languages)
+
+    telemetry = TelemetryWriter(args.telemetry, args.telemetry_format, args.telemetry_every) if args.telemetry else None
+    progress = ProgressReporter(args.total, args.progress_every, telemetry)
+    progress.memory = budget
+
+    def flush(scan: LanguageScan) -> None:
+        start = time.perf_counter()
+        flush_repo_info(scan, args.spill_dir)
+        progress.flushed(time.perf_counter() - start)
+
+    read_source_files = source_file_reader(args.engine)
+    samples: Dict[str, RepoSample] = {}
+
+    def scan_batch(batch: pa.RecordBatch) -> None:
+        if args.engine == "arrow":
+            for language, files in scan_batch_arrow(batch, extension_map, scans).items():
+                progress.advance(files)
+                if len(scans[language].repo_info) >= args.flush_repos:
+                    flush(scans[language])
+            return
+        for language, repo_name, path_value, text in read_source_files(batch, extension_map):
+            scan = scans[language]
+            scan_file(scan, repo_name, path_value, text)
+            progress.advance()
+            if len(scan.repo_info) >= args.flush_repos:
+                flush(scan)
+
+    def scan_budgeted(batch: pa.RecordBatch) -> None:
+        if budget is None:
+            scan_batch(batch)
+            return
+        for piece in split_batch(batch, budget.batch_bytes):
+            scan_batch(piece)
+            budget.check(scans, piece, flush)
+
+    def finish() -> int:
+        for scan in scans.values():
+            finish_language_scan(scan, args.spill_dir)
+            print(f"END: Data has been written to {scan.output_path} incrementally ({scan.count:,} files).")
+            if scan.match_cache is not None:
+                cache = scan.match_cache
+                print(f"END: Match cache hit rate {cache.hit_rate:.1%} ({cache.hits:,} of {cache.lookups:,} files).")
+                if args.match_cache_dir:
+                    cache.save(MatchCache.path(args.match_cache_dir, scan.language), scan.method_names)
+            if scan.profile is not None:
+                write_profile_report(scan)
+                print(f"END: Pattern profile written to {scan.profile_path}.")
+            if scan.import_lines is not None:
+                write_result_patterns(scan)
+            if scan.shard is not None:
+                shard_config = {
+                    "header_region": options.header_region,
+                    "header_bytes": options.header_bytes,
+                    "language_filter": args.language_filter,
+                    "presence": options.presence,
+                }
+                write_shard_manifest(scan, parquet_files, shard_config)
+                print(f"END: Shard manifest written to {scan.manifest_path}.")
+            if scan.language in samples:
+                sample = samples[scan.language]
+                write_json_atomic(scan.sample_path, sample.info(scan.language, sample_margin, args.sample_seed))
+                print(
+                    f"END: Sampled {sample.taken:,} of {sample.population:,} {scan.language} repos, "
+                    f"see {scan.sample_path}."
+                )
+        if args.checkpoint and Path(args.checkpoint).exists():
+            os.remove(args.checkpoint)
+        if args.spill_dir:
+            for scan in scans.values():
+                remove_spill_runs(args.spill_dir, scan.stem)
+        progress.finish()
+        if budget is not None:
+            print(f"END: Memory budget: {budget.summary()}.")
+        if args.telemetry:
+            print(f"END: Telemetry written to {args.telemetry}.")
+        return 0
+
+    if args.stream:
+        try:
+            rows = open_stream_rows(args.stream, args.data_files)
+        except RuntimeError as exc:
+            print(f"Error: {exc}", file=sys.stderr)
+            return 1
+        batches = iter_stream_batches(rows, args.batch_size, budget.batch_bytes if budget is not None else None)
+        if args.prefetch > 0:
+            with Prefetcher(batches, args.prefetch) as prefetched:
+                progress.queue_depth = prefetched.queue.qsize
+                for batch in prefetched:
+                    progress.read(batch.num_rows, batch.nbytes)
+                    scan_budgeted(batch)
+        else:
+            for batch in batches:
+                progress.read(batch.num_rows, batch.nbytes)
+                scan_budgeted(batch)
+        return finish()
+
+    if not parquet_files:
+        return finish()
 
     dataset = ds.dataset(parquet_files, format="parquet")
     schema_names = set(dataset.schema.names)
-    required = {"repo_name", "path", "content"}
+    required = set(SCAN_COLUMNS)
     if not required.issubset(schema_names):
         print(
             f"Error: parquet schema is missing required columns. Found: {sorted(schema_names)}",
@@ -409,60 +3639,140 @@ def main() -> int:
         )
         return 1
 
-    scanner = dataset.scanner(columns=["repo_name", "path", "content"], batch_size=args.batch_size)
-
-    for batch in scanner.to_batches():
-        columns = batch.to_pydict()
-        repo_names = columns["repo_name"]
-        paths = columns["path"]
-        contents = columns["content"]
+    language_values: Optional[List[str]] = None
+    if args.language_filter:
+        if LANGUAGE_COLUMN in schema_names:
+            language_values = dataset_language_values(languages)
+        else:
+            print(
+                f"Warning: no '{LANGUAGE_COLUMN}' column in the parquet schema, filtering by extension only.",
+                file=sys.stderr,
+            )
+    filter_expression = scan_filter_expression(extension_map, language_values)
 
-        for repo_name, path_value, content in zip(repo_names, paths, contents):
-            if repo_name is None or path_value is None or content is None:
-                continue
-            if not path_matches_language(str(path_value), extensions):
-                continue
+    units = list_scan_units(parquet_files, language_values)
+    if language_values:
+        print(f"INFO: {len(units):,} row groups may contain {', '.join(language_values)}.")
 
-            repo_name = str(repo_name)
-            if repo_name not in repo_info:
-                repo_info[repo_name] = {
-                    "num_files": 0,
-                    "languages": {language},
-                    **{method: 0 for method, _ in compiled_patterns},
+    if sample_margin is not None:
+        print(f"INFO: indexing the repos in {len(units):,} row groups.")
+        repo_units = index_repo_units(units, extension_map, filter_expression, args.batch_size)
+        for language in languages:
+            samples[language] = RepoSample(repo_units[language], scans[language].method_names, args.sample_seed)
+            print(f"INFO: {samples[language].population:,} {language} repos to sample from.")
+        round_sizes = {language: args.sample_repos for language in languages}
+        with tempfile.TemporaryDirectory(prefix="sample-", dir=args.spill_dir) as cache_dir:
+            cache = SampleUnitCache(cache_dir, units, repo_units.values(), filter_expression, args.batch_size)
+            while True:
+                drawn = {
+                    language: sample.take(round_sizes[language])
+                    for language, sample in samples.items()
+                    if not sample.done(sample_margin)
                 }
-
-            info = repo_info[repo_name]
-            info["num_files"] += 1
-            info["languages"].add(language)
-
-            text = str(content)
-            for method, cre in compiled_patterns:
-                info[method] += len(cre.findall(text))
-
-            count += 1
-            if len(repo_info) >= args.flush_repos:
-                write_all_repo_data(csv_file_path, method_names, repo_info)
-                repo_info.clear()
-
-            if args.progress_every > 0 and count % args.progress_every == 0:
-                loop_end_time = datetime.datetime.now()
-                loop_duration = loop_end_time - loop_start_time
-                formatted_duration = f"{loop_duration.total_seconds():.2f}"
-                if total:
-                    left = f"{max(total - count, 0):,}"
-                    per = round(100 - count / total * 100, 2)
+                if not drawn:
+                    break
+                for language, repos in drawn.items():
+                    cache.take(repo_units[language], repos)
+                # Each round reads only the row groups holding its repos, and only their rows.
+                wanted = sorted(set().union(*drawn.values()))
+                round_units = sorted(
+                    {index for language, repos in drawn.items() for repo in repos for index in repo_units[language][repo]}
+                )
+                for unit_index in round_units:
+                    for batch in cache.batches(unit_index, wanted, lambda batch: progress.read(batch.num_rows, batch.nbytes)):
+                        for language, repo_name, path_value, text in read_source_files(batch, extension_map):
+                            if repo_name in drawn.get(language, ()):
+                                scan_file(scans[language], repo_name, path_value, text)
+                                progress.advance()
+                cache.release()
+                for language in drawn:
+                    sample = samples[language]
+                    sample.add(scans[language].repo_info)
+                    flush(scans[language])
+                    method, half = sample.widest()
                     print(
-                        f"STAT: {left} files left ({per}%). Running for {datetime.datetime.now() - job_start_time}.",
-                        end=" ",
+                        f"SAMPLE: {language} round {sample.rounds}: {sample.taken:,} of {sample.population:,} repos "
+                        f"({sample.with_any:,} with any method) from {len(round_units):,} row groups, "
+                        f"widest interval +/-{100 * half:.2f} pp ({method})."
                     )
+                    round_sizes[language] = sample.next_round(sample_margin, args.sample_repos)
+        return finish()
+
+    config = checkpoint_config(languages, parquet_files, language_values, args.spill_dir, options)
+    units_done = 0
+    if args.resume:
+        try:
+            units_done, progress.count = restore_checkpoint(args.checkpoint, config, scans)
+        except (OSError, ValueError, KeyError) as exc:
+            print(f"Error: cannot resume: {exc}", file=sys.stderr)
+            return 1
+        print(f"INFO: resuming after {units_done:,} of {len(units):,} row groups ({progress.count:,} files).")
+    unit_sizes = scan_unit_sizes(units)
+    progress.set_totals(unit_sizes, units_done)
+    last_checkpoint = time.monotonic()
+
+    def unit_finished() -> None:
+        nonlocal units_done, last_checkpoint
+        unit_rows, unit_bytes = unit_sizes[units_done]
+        units_done += 1
+        for scan in scans.values():
+            if scan.file_records is not None and len(scan.file_records) >= PARQUET_PART_ROWS:
+                start = time.perf_counter()
+                flush_file_records(scan)
+                progress.flushed(time.perf_counter() - start)
+        progress.read(unit_rows, unit_bytes, units=1)
+        if args.checkpoint and time.monotonic() - last_checkpoint >= args.checkpoint_every:
+            write_checkpoint(args.checkpoint, config, units_done, progress.count, scans)
+            last_checkpoint = time.monotonic()
+
+    remaining_units = units[units_done:]
+    if args.workers > 1:
+        def set_in_flight(depth: int) -> None:
+            progress.queue_depth = lambda: depth
+
+        for partial in iter_parallel_partials(
+            remaining_units,
+            languages,
+            options,
+            args.batch_size,
+            filter_expression,
+            args.workers,
+            set_in_flight,
+            (lambda: budget.batch_bytes) if budget is not None else None,
+        ):
+            for language, (repo_info, files, file_records, profile, cache_delta) in partial.items():
+                scan = scans[language]
+                merge_repo_info(scan.repo_info, repo_info)
+                scan.count += files
+                if file_records:
+                    scan.file_records.extend(file_records)
+                if profile is not None:
+                    scan.profile.merge(profile)
+                if cache_delta is not None:
+                    merge_cache_delta(scan.match_cache, cache_delta)
+                progress.advance(files)
+                if len(scan.repo_info) >= args.flush_repos:
+                    flush(scan)
+            if budget is not None:
+                budget.check(scans, None, flush)
+            unit_finished()
+    else:
+        unit_batch_size = budget.unit_batch_size(dict(zip(units, unit_sizes)), args.batch_size) if budget else None
+        stream = iter_units_stream(remaining_units, args.batch_size, filter_expression, unit_batch_size)
+        prefetcher = Prefetcher(stream, args.prefetch) if args.prefetch > 0 else None
+        if prefetcher is not None:
+            progress.queue_depth = prefetcher.queue.qsize
+        try:
+            for batch in prefetcher if prefetcher is not None else stream:
+                if batch is None:
+                    unit_finished()
                 else:
-                    print(f"STAT: {count:,} matching source files scanned. Running for {datetime.datetime.now() - job_start_time}.", end=" ")
-                print(f"This loop took {formatted_duration} seconds.")
-                loop_start_time = datetime.datetime.now()
+                    scan_budgeted(batch)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
 
-    write_all_repo_data(csv_file_path, method_names, repo_info)
-    print(f"END: Data has been written to {csv_file_path} incrementally.")
-    return 0
+    return finish()
 
 
 if __name__ == "__main__":
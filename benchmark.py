@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for analyze.py on synthetic github-code Parquet files.
+
+    python benchmark.py generate --out bench_data --rows 200000
+    python benchmark.py run --data-files "bench_data/*.parquet" python ruby
+
+`generate` writes files with the repo_name/path/content schema (plus the
+language, license and size columns of the real dataset), a language mix
+weighted like TOTALS, log-normal file sizes, byte-identical duplicates and planted matches for
+every PATTERNS entry. `run` times each engine configuration per language, splits
+the time into read, convert and match stages, and checks that every
+configuration gives the same per-repo results as the original scan loop.
+"""
+
+import argparse
+import math
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import analyze
+from analyze import sre_parse
+
+# Rows that belong to languages analyze.py does not scan.
+OTHER_LANGUAGES: Dict[str, Tuple[str, ...]] = {
+    "Markdown": (".md",),
+    "HTML": (".html",),
+    "CSS": (".css",),
+    "Shell": (".sh",),
+    "Rust": (".rs",),
+    "Text": (".txt",),
+}
+OTHER_SHARE = 0.3
+
+FILLER_LINES: Dict[str, Tuple[str, ...]] = {
+    "c": ("int value = compute(a, b);", "for (i = 0; i < n; i++) {", "    total += items[i];", "}", "/* helper */"),
+    "cpp": ("std::vector<int> values;", "auto it = values.begin();", "if (ok) { return x; }", "// comment", "}"),
+    "csharp": ("public int Count { get; set; }", "var list = new List<string>();", "return result;", "}", "// TODO"),
+    "go": ("func helper(x int) int {", "\treturn x * 2", "}", "if err != nil {", "\treturn err"),
+    "java": ("// Größe prüfen — señor", "private final int count;", "public void run() {", "    list.add(item);", "}", "// note"),
+    "javascript": ("const value = compute(a, b);", "function run(x) {", "  return x * 2;", "}", "// note"),
+    "php": ("$value = compute($a, $b);", "function run($x) {", "    return $x * 2;", "}", "// note"),
+    "python": ("# Überprüfe die Größe — naïve café", "def helper(x):", "    return x * 2", "value = compute(a, b)", "# comment", "for item in items:"),
+    "ruby": ("# Grüße — café", "def helper(x)", "  x * 2", "end", "# comment", "items.each do |item|"),
+    None: ("Lorem ipsum dolor sit amet. Grüße, café", "<div class=\"row\">", "color: #333;", "echo done", "fn main() {}"),
+}
+
+
+def sample_match(items: Sequence[Tuple[object, object]], rng: random.Random) -> str:
+    """A short string built from a parsed regex, choosing random branches."""
+    out: List[str] = []
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            out.append(chr(av))
+        elif op is sre_parse.NOT_LITERAL:
+            out.append("x" if chr(av) != "x" else "y")
+        elif op is sre_parse.ANY:
+            out.append("x")
+        elif op is sre_parse.IN:
+            out.append(_sample_in(av))
+        elif op is sre_parse.BRANCH:
+            out.append(sample_match(rng.choice(av[1]), rng))
+        elif op is sre_parse.SUBPATTERN:
+            out.append(sample_match(av[3], rng))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, _, sub = av
+            out.extend(sample_match(sub, rng) for _ in range(low))
+    return "".join(out)
+
+
+def _sample_in(av: Sequence[Tuple[object, object]]) -> str:
+    if av and av[0][0] is sre_parse.NEGATE:
+        excluded = {chr(value) for op, value in av[1:] if op is sre_parse.LITERAL}
+        return next(char for char in "xyz_" if char not in excluded)
+    op, value = av[0]
+    if op is sre_parse.LITERAL:
+        return chr(value)
+    if op is sre_parse.RANGE:
+        return chr(value[0])
+    if op is sre_parse.CATEGORY:
+        return {sre_parse.CATEGORY_SPACE: " ", sre_parse.CATEGORY_DIGIT: "0"}.get(value, "a")
+    return "a"
+
+
+def planted_samples(language: str, rng: random.Random) -> Dict[str, List[str]]:
+    """Several matching strings for every method of the language."""
+    samples: Dict[str, List[str]] = {}
+    for method, cre in analyze.compile_patterns(language):
+        parsed = sre_parse.parse(cre.pattern)
+        found = {text for text in (sample_match(parsed, rng) for _ in range(20)) if cre.search(f" {text} ")}
+        if not found:
+            raise ValueError(f"cannot build a sample for {language}/{method}")
+        samples[method] = sorted(found)
+    return samples
+
+
+def synthetic_file(
+    language: Optional[str], samples: Dict[str, Dict[str, List[str]]], plant_rate: float, rng: random.Random
+) -> str:
+    """Filler lines of the language with a log-normal size, sometimes with planted matches."""
+    filler = FILLER_LINES[language]
+    size = min(int(rng.lognormvariate(7.5, 1.3)), 1_000_000)
+    lines = [rng.choice(filler) for _ in range(min(max(size // 24, 1), 64))]
+    body = "\n".join(lines)
+    body = body * max(size // max(len(body), 1), 1)
+    if language is not None and rng.random() < plant_rate:
+        planted = []
+        for _ in range(rng.randint(1, 3)):
+            method = rng.choice(list(samples[language]))
+            planted.append(rng.choice(samples[language][method]))
+        if rng.random() < 0.1:
+            body = body + "\n" + "\n".join(planted) + "\n"
+        else:
+            body = "\n".join(planted) + "\n" + body
+    return body
+
+
+def generate(
+    out_dir: Path, rows: int, files: int, row_group_size: int, plant_rate: float, duplicate_rate: float, seed: int
+) -> None:
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    languages = list(analyze.PATTERNS)
+    weights = [analyze.TOTALS[language] for language in languages]
+    scanned_share = 1.0 - OTHER_SHARE
+    total_weight = sum(weights)
+    choices: List[Tuple[Optional[str], str, Tuple[str, ...]]] = []
+    choice_weights: List[float] = []
+    for language, weight in zip(languages, weights):
+        choices.append((language, analyze.DATASET_LANGUAGES[language][0], analyze.EXTENSIONS[language]))
+        choice_weights.append(scanned_share * weight / total_weight)
+    for label, extensions in OTHER_LANGUAGES.items():
+        choices.append((None, label, extensions))
+        choice_weights.append(OTHER_SHARE / len(OTHER_LANGUAGES))
+
+    samples = {language: planted_samples(language, rng) for language in languages}
+    # Recent contents per language, copied verbatim to model vendored files and forks.
+    recent: Dict[Optional[str], List[str]] = {}
+    num_repos = max(rows // 8, 1)
+
+    rows_per_file = math.ceil(rows / files)
+    for file_index in range(files):
+        columns: Dict[str, List[object]] = {
+            "repo_name": [], "path": [], "content": [], "language": [], "license": [], "size": []
+        }
+        for row in range(min(rows_per_file, rows - file_index * rows_per_file)):
+            language, label, extensions = rng.choices(choices, choice_weights)[0]
+            repo = int(rng.paretovariate(1.1) * 7) % num_repos
+            previous = recent.setdefault(language, [])
+            if previous and rng.random() < duplicate_rate:
+                body = rng.choice(previous)
+            else:
+                body = synthetic_file(language, samples, plant_rate, rng)
+                previous.append(body)
+                if len(previous) > 1000:
+                    previous.pop(rng.randrange(len(previous)))
+            columns["repo_name"].append(f"user{repo % 997}/repo{repo}")
+            columns["path"].append(f"src/dir{row % 17}/file{row}{rng.choice(extensions)}")
+            columns["content"].append(body)
+            columns["language"].append(label)
+            columns["license"].append("mit")
+            columns["size"].append(len(body))
+        path = out_dir / f"train-{file_index:05d}-of-{files:05d}.parquet"
+        pq.write_table(pa.table(columns), path, row_group_size=row_group_size, compression="snappy")
+        print(f"wrote {path} ({len(columns['path']):,} rows)")
+
+
+@dataclass
+class StageTimes:
+    read: float = 0.0
+    convert: float = 0.0
+    match: float = 0.0
+    files: int = 0
+    chars: int = 0  # characters, or bytes with the bytes engine; not counted by the arrow engine
+    wall: float = 0.0
+    cache_hit_rate: Optional[float] = None
+
+
+@dataclass
+class Engine:
+    """One analyze.py configuration to benchmark."""
+
+    name: str
+    options: analyze.ScanOptions = field(default_factory=analyze.ScanOptions)
+    workers: int = 1
+    prefetch: int = 0
+
+
+ENGINES: Dict[str, Engine] = {
+    "baseline": Engine("baseline"),
+    "prefetch": Engine("prefetch", prefetch=2),
+    "prefilter": Engine("prefilter", analyze.ScanOptions(prefilter=True)),
+    "header": Engine("header", analyze.ScanOptions(header_region=True)),
+    "workers": Engine("workers", workers=4),
+    "cache": Engine("cache", analyze.ScanOptions(match_cache=1_000_000)),
+    "bytes": Engine("bytes", analyze.ScanOptions(engine="bytes")),
+    "arrow": Engine("arrow", analyze.ScanOptions(engine="arrow")),
+    "presence": Engine("presence", analyze.ScanOptions(presence=True)),
+}
+
+# Engines that are expected to change results and are only timed.
+APPROXIMATE_ENGINES = {"header"}
+# Engines that only record whether a method occurs; compared on that.
+PRESENCE_ENGINES = {"presence"}
+
+RepoResults = Dict[str, Dict[str, object]]
+
+
+def reference_scan(parquet_files: Sequence[str], language: str, batch_size: int) -> RepoResults:
+    """The scan loop as analyze.py originally ran it, used as ground truth."""
+    compiled_patterns = analyze.compile_patterns(language)
+    extensions = analyze.EXTENSIONS[language]
+    repo_info: RepoResults = {}
+    dataset = ds.dataset(list(parquet_files), format="parquet")
+    for batch in dataset.scanner(columns=analyze.SCAN_COLUMNS, batch_size=batch_size).to_batches():
+        columns = batch.to_pydict()
+        for repo_name, path_value, content in zip(columns["repo_name"], columns["path"], columns["content"]):
+            if repo_name is None or path_value is None or content is None:
+                continue
+            if not analyze.path_matches_language(str(path_value), extensions):
+                continue
+            info = repo_info.setdefault(
+                str(repo_name), analyze.new_repo_entry(language, [method for method, _ in compiled_patterns])
+            )
+            info["num_files"] += 1
+            text = str(content)
+            for method, cre in compiled_patterns:
+                info[method] += len(cre.findall(text))
+    return repo_info
+
+
+def timed(iterator, times: StageTimes, stage: str):
+    """Yield from iterator, adding the time spent producing items to a stage."""
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            setattr(times, stage, getattr(times, stage) + time.perf_counter() - start)
+            return
+        setattr(times, stage, getattr(times, stage) + time.perf_counter() - start)
+        yield item
+
+
+def run_engine(
+    engine: Engine, parquet_files: Sequence[str], language: str, batch_size: int
+) -> Tuple[RepoResults, StageTimes]:
+    times = StageTimes()
+    units = analyze.list_scan_units(parquet_files)
+    extension_map = analyze.build_extension_map([language])
+    filter_expression = analyze.scan_filter_expression(extension_map)
+    scan = analyze.make_language_scan(language, engine.options)
+    wall_start = time.perf_counter()
+
+    if engine.workers > 1:
+        for partial in analyze.iter_parallel_partials(
+            units, [language], engine.options, batch_size, filter_expression, engine.workers
+        ):
+            repo_info, files, _, _, cache_delta = partial[language]
+            analyze.merge_repo_info(scan.repo_info, repo_info)
+            times.files += files
+            if cache_delta is not None:
+                analyze.merge_cache_delta(scan.match_cache, cache_delta)
+        times.wall = time.perf_counter() - wall_start
+        if scan.match_cache is not None:
+            times.cache_hit_rate = scan.match_cache.hit_rate
+        return scan.repo_info, times
+
+    read_source_files = analyze.source_file_reader(engine.options.engine)
+    stream = analyze.iter_units_stream(units, batch_size, filter_expression)
+    prefetcher = analyze.Prefetcher(stream, engine.prefetch) if engine.prefetch > 0 else None
+    batches = iter(prefetcher) if prefetcher is not None else stream
+    try:
+        for batch in timed(batches, times, "read"):
+            if batch is None:
+                continue
+            if engine.options.engine == "arrow":
+                start = time.perf_counter()
+                times.files += sum(analyze.scan_batch_arrow(batch, extension_map, {language: scan}).values())
+                times.match += time.perf_counter() - start
+                continue
+            for _, repo_name, path_value, text in timed(
+                read_source_files(batch, extension_map), times, "convert"
+            ):
+                start = time.perf_counter()
+                analyze.scan_file(scan, repo_name, path_value, text)
+                times.match += time.perf_counter() - start
+                times.files += 1
+                times.chars += len(text)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    times.wall = time.perf_counter() - wall_start
+    if scan.match_cache is not None:
+        times.cache_hit_rate = scan.match_cache.hit_rate
+    return scan.repo_info, times
+
+
+def same_results(left: RepoResults, right: RepoResults, method_names: Sequence[str], presence: bool = False) -> bool:
+    if left.keys() != right.keys():
+        return False
+    if presence:
+        return all(
+            left[repo]["num_files"] == right[repo]["num_files"]
+            and all((left[repo][method] > 0) == (right[repo][method] > 0) for method in method_names)
+            for repo in left
+        )
+    keys = ["num_files"] + list(method_names)
+    return all(left[repo][key] == right[repo][key] for repo in left for key in keys)
+
+
+def run(parquet_files: Sequence[str], languages: Sequence[str], engine_names: Sequence[str], batch_size: int) -> int:
+    header = (
+        f"{'language':<11} {'engine':<10} {'files':>9} {'MB':>8} {'wall s':>8} {'files/s':>9} {'MB/s':>7} "
+        f"{'read s':>7} {'conv s':>7} {'match s':>8}  result"
+    )
+    print(header)
+    print("-" * len(header))
+    mismatches = 0
+    for language in languages:
+        reference = reference_scan(parquet_files, language, batch_size)
+        method_names = analyze.PATTERNS[language].keys()
+        for name in engine_names:
+            repo_info, times = run_engine(ENGINES[name], parquet_files, language, batch_size)
+            if name in APPROXIMATE_ENGINES:
+                verdict = "approximate"
+            elif same_results(repo_info, reference, list(method_names), name in PRESENCE_ENGINES):
+                verdict = "same"
+            else:
+                verdict = "DIFFERENT"
+                mismatches += 1
+            if times.cache_hit_rate is not None:
+                verdict += f" (cache hit rate {times.cache_hit_rate:.1%})"
+            megabytes = times.chars / 1e6
+            wall = times.wall or float("nan")
+            stages = (
+                f"{times.read:>7.2f} {times.convert:>7.2f} {times.match:>8.2f}"
+                if ENGINES[name].workers == 1
+                else f"{'-':>7} {'-':>7} {'-':>8}"
+            )
+            mb = f"{megabytes:>8.1f}" if times.chars else f"{'-':>8}"
+            mb_per_s = f"{megabytes / wall:>7.1f}" if times.chars else f"{'-':>7}"
+            print(
+                f"{language:<11} {name:<10} {times.files:>9,} {mb} {wall:>8.2f} {times.files / wall:>9,.0f} "
+                f"{mb_per_s} {stages}  {verdict}"
+            )
+    return 1 if mismatches else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark analyze.py on synthetic github-code Parquet files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gen = subparsers.add_parser("generate", help="Write synthetic Parquet files")
+    gen.add_argument("--out", type=Path, default=Path("bench_data"), help="Output directory")
+    gen.add_argument("--rows", type=int, default=200_000, help="Total rows")
+    gen.add_argument("--files", type=int, default=4, help="Number of Parquet files")
+    gen.add_argument("--row-group-size", type=int, default=10_000, help="Rows per row group")
+    gen.add_argument("--plant-rate", type=float, default=0.15, help="Share of source files with planted matches")
+    gen.add_argument("--duplicate-rate", type=float, default=0.2, help="Share of files that copy an earlier file")
+    gen.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    bench = subparsers.add_parser("run", help="Time engine configurations on Parquet files")
+    bench.add_argument("languages", nargs="+", help="Language name(s), or 'all'")
+    bench.add_argument("--data-files", default="bench_data/*.parquet", help="Glob for parquet files")
+    bench.add_argument(
+        "--engines",
+        nargs="+",
+        choices=sorted(ENGINES),
+        default=list(ENGINES),
+        help="Engine configurations to run",
+    )
+    bench.add_argument("--workers", type=int, default=4, help="Processes for the 'workers' engine")
+    bench.add_argument("--batch-size", type=int, default=8192, help="Arrow batch size")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate(args.out, args.rows, args.files, args.row_group_size, args.plant_rate, args.duplicate_rate, args.seed)
+        return 0
+
+    try:
+        languages = analyze.resolve_languages(args.languages)
+    except ValueError as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+    parquet_files = analyze.iter_parquet_files(args.data_files)
+    if not parquet_files:
+        print(f"Error: no parquet files matched: {args.data_files}", file=sys.stderr)
+        return 1
+    ENGINES["workers"].workers = args.workers
+    return run(parquet_files, languages, args.engines, args.batch_size)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
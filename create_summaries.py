@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
-import math
+import csv
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+
+from stats import wilson_ci
 
 
 LANGUAGE_FILE_ORDER = [
@@ -20,24 +31,14 @@ LANGUAGE_FILE_ORDER = [
     "csharp.csv",
 ]
 
+# Bytes of CSV parsed per chunk; only the running totals are kept between chunks.
+CSV_BLOCK_SIZE = 16 << 20
 
-def wilson_ci(k: int, n: int, z: float = 1.96) -> Tuple[float, float]:
-    """
-    Wilson score interval for a binomial proportion.
-    Returns (lower, upper) as proportions in [0, 1].
-    """
-    if n == 0:
-        return (0.0, 0.0)
-
-    phat = k / n
-    denom = 1.0 + (z * z) / n
-    center = (phat + (z * z) / (2.0 * n)) / denom
-    margin = (
-        z
-        * math.sqrt((phat * (1.0 - phat) / n) + ((z * z) / (4.0 * n * n)))
-        / denom
-    )
-    return (max(0.0, center - margin), min(1.0, center + margin))
+# Bump when the analyze_language result changes shape, to drop old caches.
+SUMMARY_CACHE_VERSION = 3
+
+# Set bits per byte value, for numpy versions without np.bitwise_count.
+BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.int64)
 
 
 def format_pct(x: float, decimals: int = 1) -> str:
@@ -66,8 +67,13 @@ def latex_escape(text: str) -> str:
     return out
 
 
+SAMPLE_SUFFIX = ".sample"
+
+
 def language_label_from_filename(filename: str) -> str:
     stem = Path(filename).stem
+    if stem.endswith(SAMPLE_SUFFIX):
+        stem = stem[: -len(SAMPLE_SUFFIX)]
     mapping = {
         "c++": "C++",
         "cpp": "C++",
@@ -83,21 +89,25 @@ def language_label_from_filename(filename: str) -> str:
     return mapping.get(stem.lower(), stem)
 
 
-def load_language_csv(csv_path: Path) -> Tuple[List[str], pd.DataFrame]:
-    df = pd.read_csv(csv_path)
-
+def split_method_columns(columns: List[str], name: str) -> List[str]:
     expected_prefix = ["repo_name", "num_files", "languages"]
-    missing = [c for c in expected_prefix if c not in df.columns]
+    missing = [c for c in expected_prefix if c not in columns]
     if missing:
         raise ValueError(
-            f"{csv_path.name}: missing required columns: {', '.join(missing)}"
+            f"{name}: missing required columns: {', '.join(missing)}"
         )
 
-    lang_col_idx = list(df.columns).index("languages")
-    method_cols = list(df.columns)[lang_col_idx + 1 :]
+    lang_col_idx = columns.index("languages")
+    method_cols = columns[lang_col_idx + 1 :]
 
     if not method_cols:
-        raise ValueError(f"{csv_path.name}: no data access method columns found")
+        raise ValueError(f"{name}: no data access method columns found")
+    return method_cols
+
+
+def load_language_csv(csv_path: Path) -> Tuple[List[str], pd.DataFrame]:
+    df = pd.read_csv(csv_path)
+    method_cols = split_method_columns(list(df.columns), csv_path.name)
 
     df["num_files"] = pd.to_numeric(df["num_files"], errors="coerce").fillna(0).astype(int)
 
@@ -110,20 +120,142 @@ def load_language_csv(csv_path: Path) -> Tuple[List[str], pd.DataFrame]:
     return method_cols, df
 
 
-def analyze_language(csv_path: Path) -> Dict:
-    method_cols, df = load_language_csv(csv_path)
+def new_totals(method_cols: List[str], cooccurrence: bool = False) -> Dict:
+    """Zeroed totals; the co-occurrence matrix is only kept when asked for (--cooccurrence)."""
+    return {
+        "n_total_rows": 0,
+        "n_total_files": 0,
+        "n_with_any_method": 0,
+        "n_files_with_any_method": 0,
+        "counts": {method: 0 for method in method_cols},
+        "cooccurrence": np.zeros((len(method_cols), len(method_cols)), dtype=np.int64) if cooccurrence else None,
+    }
+
+
+def pack_flags(flags: List[np.ndarray]) -> np.ndarray:
+    """One row of packed uint64 words per method; bit r is set when row r has the method."""
+    packed = np.packbits(np.vstack(flags), axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
 
-    has_any_method = df[method_cols].sum(axis=1) > 0
-    eligible_df = df.loc[has_any_method].copy()
-    total_with_any_method = len(eligible_df)
+def popcount_rows(words: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    return BYTE_POPCOUNT[words.view(np.uint8)].sum(axis=1)
 
-    total_repositories = len(df)
-    total_files = int(df["num_files"].sum())
-    eligible_files = int(eligible_df["num_files"].sum())
 
-    counts = {}
+def add_cooccurrence(matrix: np.ndarray, flags: List[np.ndarray]) -> None:
+    """Add the number of rows holding both methods i and j to matrix[i, j]."""
+    packed = pack_flags(flags)
+    for index in range(len(flags)):
+        both = popcount_rows(packed[index] & packed[index:])
+        matrix[index, index:] += both
+        matrix[index + 1 :, index] += both[1:]
+
+
+def add_batch_totals(totals: Dict, batch: pa.RecordBatch, method_cols: List[str]) -> None:
+    """Add one chunk of integer num_files/method columns to the running totals."""
+    num_files = pc.fill_null(batch.column("num_files"), 0)
+    has_any_method = pa.array([False] * batch.num_rows)
+    flags = []
     for method in method_cols:
-        counts[method] = int(eligible_df[method].sum())
+        present = pc.fill_null(pc.not_equal(batch.column(method), 0), False)
+        totals["counts"][method] += pc.sum(present).as_py() or 0
+        has_any_method = pc.or_(has_any_method, present)
+        if totals["cooccurrence"] is not None:
+            flags.append(present.to_numpy(zero_copy_only=False))
+    if batch.num_rows and totals["cooccurrence"] is not None:
+        add_cooccurrence(totals["cooccurrence"], flags)
+
+    totals["n_total_rows"] += batch.num_rows
+    totals["n_total_files"] += pc.sum(num_files).as_py() or 0
+    totals["n_with_any_method"] += pc.sum(has_any_method).as_py() or 0
+    totals["n_files_with_any_method"] += pc.sum(pc.filter(num_files, has_any_method)).as_py() or 0
+
+
+def aggregate_batches(batches: Iterable[pa.RecordBatch], method_cols: List[str], cooccurrence: bool = False) -> Dict:
+    totals = new_totals(method_cols, cooccurrence)
+    for batch in batches:
+        add_batch_totals(totals, batch, method_cols)
+    return totals
+
+
+def aggregate_csv(csv_path: Path, cooccurrence: bool = False) -> Dict:
+    """
+    Stream the CSV in CSV_BLOCK_SIZE chunks, parsing only num_files and the
+    method columns, as int64. A file with values that are not plain integers
+    is read with pandas instead, which coerces them like load_language_csv.
+    """
+    with open(csv_path, newline="", encoding="utf-8") as handle:
+        header = next(csv.reader(handle), [])
+    method_cols = split_method_columns(header, csv_path.name)
+
+    columns = ["num_files"] + method_cols
+    try:
+        reader = pacsv.open_csv(
+            csv_path,
+            read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=columns,
+                column_types={column: pa.int64() for column in columns},
+            ),
+        )
+        return aggregate_batches(reader, method_cols, cooccurrence)
+    except pa.ArrowInvalid:
+        _, df = load_language_csv(csv_path)
+        return aggregate_batches(pa.Table.from_pandas(df[columns], preserve_index=False).to_batches(), method_cols, cooccurrence)
+
+
+def aggregate_parquet(parquet_path: Path, cooccurrence: bool = False) -> Dict:
+    """
+    Stream the typed Parquet output of analyze.py (a file or a directory of
+    parts) batch by batch.
+    """
+    dataset = ds.dataset(str(parquet_path), format="parquet")
+    method_cols = split_method_columns(dataset.schema.names, parquet_path.name)
+    return aggregate_batches(dataset.to_batches(columns=["num_files"] + method_cols), method_cols, cooccurrence)
+
+
+def aggregate_language_file(path: Path, cooccurrence: bool = False) -> Dict:
+    if path.suffix == ".parquet":
+        return aggregate_parquet(path, cooccurrence)
+    return aggregate_csv(path, cooccurrence)
+
+
+def find_language_file(input_dir: Path, filename: str, sampled: bool = False) -> Path:
+    """
+    Prefer <language>.parquet over <language>.csv when both exist. With
+    sampled, look for the <language>.sample.* results of analyze.py --sample.
+    """
+    stem = Path(filename).stem + (SAMPLE_SUFFIX if sampled else "")
+    parquet_path = input_dir / f"{stem}.parquet"
+    if parquet_path.exists():
+        return parquet_path
+    return input_dir / f"{stem}{Path(filename).suffix}"
+
+
+def sample_info_path(path: Path) -> Path:
+    """<language>.sample.json, written by analyze.py --sample next to its results."""
+    return path.with_name(f"{path.stem}.json")
+
+
+def read_sample_info(path: Path) -> Optional[Dict]:
+    if not path.stem.endswith(SAMPLE_SUFFIX):
+        return None
+    try:
+        with open(sample_info_path(path), encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def analyze_language(csv_path: Path, cooccurrence: bool = False) -> Dict:
+    totals = aggregate_language_file(csv_path, cooccurrence)
+    total_with_any_method = totals["n_with_any_method"]
+    counts = totals["counts"]
 
     rows = []
     for method, count in counts.items():
@@ -142,17 +274,42 @@ def analyze_language(csv_path: Path) -> Dict:
     # Sort by descending count, then descending proportion, then name
     rows.sort(key=lambda x: (-x["count"], -x["proportion"], x["method"].lower()))
 
+    # Repositories with both methods, and P(column method | row method)
+    matrix = totals["cooccurrence"]
+    conditional = None
+    if matrix is not None:
+        diagonal = np.diag(matrix)
+        conditional = np.divide(matrix, diagonal[:, None], out=np.zeros(matrix.shape), where=diagonal[:, None] > 0)
+
     return {
         "language": language_label_from_filename(csv_path.name),
         "filename": csv_path.name,
-        "n_total_rows": total_repositories,
-        "n_total_files": total_files,
+        "n_total_rows": totals["n_total_rows"],
+        "n_total_files": totals["n_total_files"],
         "n_with_any_method": total_with_any_method,
-        "n_files_with_any_method": eligible_files,
+        "n_files_with_any_method": totals["n_files_with_any_method"],
         "methods": rows,
+        "method_order": list(counts),
+        "cooccurrence": matrix.tolist() if matrix is not None else None,
+        "conditional": conditional.tolist() if conditional is not None else None,
+        "sample": read_sample_info(csv_path),
     }
 
 
+def sample_note(lang_result: Dict) -> Optional[str]:
+    """How a result from analyze.py --sample was drawn, or None for a full scan."""
+    sample = lang_result.get("sample")
+    if not sample:
+        return None
+    note = (
+        f"sampled {sample['sampled_repos']:,} of {sample['population_repos']:,} repositories at random "
+        f"(seed {sample['seed']})"
+    )
+    if sample["exhausted"]:
+        return note
+    return f"{note}, until every 95% interval was within +/-{100.0 * sample['margin']:g} pp"
+
+
 def emit_comment_block(lang_result: Dict) -> str:
     lines = []
     lines.append(f"% {lang_result['language']}:")
@@ -165,6 +322,81 @@ def emit_comment_block(lang_result: Dict) -> str:
     lines.append(f"% total files: {lang_result['n_total_files']}")
     lines.append(f"% repositories with any method: {lang_result['n_with_any_method']}")
     lines.append(f"% files in repositories with any method: {lang_result['n_files_with_any_method']}")
+    note = sample_note(lang_result)
+    if note:
+        lines.append(f"% {note}")
+    return "\n".join(lines)
+
+
+def emit_cooccurrence_comments(lang_result: Dict) -> str:
+    """
+    Every pair of methods found together, most frequent first, with the share
+    of each method's repositories that also use the other one.
+    """
+    methods = lang_result["method_order"]
+    cooccurrence = lang_result["cooccurrence"]
+    conditional = lang_result["conditional"]
+    pairs = [
+        (cooccurrence[i][j], first, second, conditional[i][j], conditional[j][i])
+        for i, first in enumerate(methods)
+        for j, second in enumerate(methods)
+        if i < j and cooccurrence[i][j] > 0
+    ]
+    pairs.sort(key=lambda x: (-x[0], x[1].lower(), x[2].lower()))
+
+    lines = [f"% {lang_result['language']} co-occurrence (method A + method B, repositories, P(B | A), P(A | B)):"]
+    for both, first, second, given_first, given_second in pairs:
+        lines.append(f"% {first} + {second}, {both}, {round(100.0 * given_first)}%, {round(100.0 * given_second)}%")
+    return "\n".join(lines)
+
+
+def emit_cooccurrence_table(lang_result: Dict, stem: str, threshold: float = 0.04) -> str:
+    """
+    P(column method | row method) among the language's methods that exceed
+    the prevalence threshold.
+    """
+    methods = lang_result["method_order"]
+    proportions = {row["method"]: row["proportion"] for row in lang_result["methods"]}
+    selected = sorted(
+        (index for index, method in enumerate(methods) if proportions[method] > threshold),
+        key=lambda index: methods[index].lower(),
+    )
+    language = latex_escape(lang_result["language"])
+    col_labels = [latex_escape(methods[index]) for index in selected]
+    sampled = (
+        r" Estimated from a random sample of repositories."
+        if lang_result.get("sample") and not lang_result["sample"]["exhausted"]
+        else ""
+    )
+
+    lines = []
+    lines.append(r"\begin{table*}[t]")
+    lines.append(r"\centering")
+    lines.append(
+        f"\\caption{{Co-occurrence of data access methods in {language} repositories. "
+        r"Each cell reports the share of repositories using the row method that also use the column method. "
+        f"Only methods exceeding {format_pct(threshold, 0)} prevalence are shown.{sampled}}}"
+    )
+    lines.append(f"\\label{{tab:cooccurrence_{stem}}}")
+    lines.append(r"\footnotesize")
+    lines.append(r"\setlength{\tabcolsep}{4pt}")
+    lines.append(r"\renewcommand{\arraystretch}{1.15}")
+    lines.append(r"\begin{tabular}{l" + "c" * len(col_labels) + r"}")
+    lines.append(r"\hline")
+    lines.append("Method & " + " & ".join(col_labels) + r" \\")
+    lines.append(r"\hline")
+    for row_index in selected:
+        row_cells = [latex_escape(methods[row_index])]
+        for col_index in selected:
+            if col_index == row_index:
+                row_cells.append("--")
+            else:
+                row_cells.append(f"{round(100.0 * lang_result['conditional'][row_index][col_index])}\\%")
+        lines.append(" & ".join(row_cells) + r" \\")
+    lines.append(r"\hline")
+    lines.append(r"\end{tabular}")
+    lines.append(r"\end{table*}")
+
     return "\n".join(lines)
 
 
@@ -190,11 +422,18 @@ def emit_latex_table(
 ) -> str:
     selected_methods = build_table_rows(per_language, threshold=threshold)
 
+    # Languages estimated from analyze.py --sample are marked with a dagger.
+    sampled = {
+        filename
+        for filename, result in per_language.items()
+        if result.get("sample") and not result["sample"]["exhausted"]
+    }
     col_labels = [
-        latex_escape(language_label_from_filename(filename))
+        latex_escape(language_label_from_filename(filename)) + (r"$^\dagger$" if filename in sampled else "")
         for filename in ordered_filenames
         if filename in per_language
     ]
+    sampled_note = r" $^\dagger$Estimated from a random sample of repositories." if sampled else ""
 
     lines = []
     lines.append(r"\begin{table*}[t]")
@@ -203,7 +442,8 @@ def emit_latex_table(
         r"\caption{Prevalence of data access methods by language. "
         r"Cells report prevalence among repositories with at least one detected "
         r"data access method, followed by 95\% Wilson confidence intervals. "
-        r"Only methods exceeding 4\% prevalence in at least one language are shown.}"
+        r"Only methods exceeding 4\% prevalence in at least one language are shown."
+        f"{sampled_note}}}"
     )
     lines.append(r"\label{tab:data_access_methods_by_language}")
     lines.append(r"\footnotesize")
@@ -243,6 +483,91 @@ def emit_latex_table(
     return "\n".join(lines)
 
 
+def summary_cache_path(path: Path) -> Path:
+    """<language>.summary.json next to the CSV file or Parquet directory."""
+    return path.with_name(f"{path.stem}.summary.json")
+
+
+def source_files(path: Path) -> List[Path]:
+    if path.is_dir():
+        return sorted(part for part in path.rglob("*") if part.is_file())
+    return [path]
+
+
+def source_stat(path: Path) -> Dict:
+    files = source_files(path)
+    stats = [part.stat() for part in files]
+    return {
+        "files": len(files),
+        "size": sum(stat.st_size for stat in stats),
+        "mtime_ns": max((stat.st_mtime_ns for stat in stats), default=0),
+    }
+
+
+def source_hash(path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in source_files(path):
+        digest.update(str(part.relative_to(path) if path.is_dir() else part.name).encode("utf-8"))
+        with open(part, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_cached_summary(path: Path, cooccurrence: bool = False) -> Optional[Dict]:
+    """
+    The cached analyze_language result for path, if the source is unchanged.
+    Matching size and mtime are trusted; otherwise the content hash decides,
+    so a file that was only touched or copied does not need re-aggregating.
+    A changed or removed <language>.sample.json also invalidates the entry,
+    and so does a missing co-occurrence matrix when cooccurrence is asked for.
+    """
+    try:
+        with open(summary_cache_path(path), encoding="utf-8") as handle:
+            cached = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if cached.get("version") != SUMMARY_CACHE_VERSION or cached.get("filename") != path.name:
+        return None
+    if cached["result"].get("sample") != read_sample_info(path):
+        return None
+    if cooccurrence and cached["result"].get("cooccurrence") is None:
+        return None
+
+    stat = source_stat(path)
+    if stat == cached["stat"]:
+        return cached["result"]
+    if stat["size"] != cached["stat"]["size"] or source_hash(path) != cached["hash"]:
+        return None
+    write_cached_summary(path, cached["result"], stat, cached["hash"])
+    return cached["result"]
+
+
+def write_cached_summary(path: Path, result: Dict, stat: Optional[Dict] = None, digest: Optional[str] = None) -> None:
+    payload = {
+        "version": SUMMARY_CACHE_VERSION,
+        "filename": path.name,
+        "stat": stat or source_stat(path),
+        "hash": digest or source_hash(path),
+        "result": result,
+    }
+    cache_path = summary_cache_path(path)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(payload, handle)
+    os.replace(tmp_path, cache_path)
+
+
+def analyze_languages(paths: List[Path], workers: Optional[int], cooccurrence: bool = False) -> List[Dict]:
+    """analyze_language for each path, in order, using up to workers processes."""
+    if workers is None:
+        workers = min(len(paths), os.cpu_count() or 1)
+    if workers <= 1 or len(paths) <= 1:
+        return [analyze_language(path, cooccurrence) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(analyze_language, paths, [cooccurrence] * len(paths)))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description=(
@@ -253,7 +578,7 @@ def main() -> None:
     parser.add_argument(
         "directory",
         type=Path,
-        help="Directory containing the language CSV files",
+        help="Directory containing the language CSV (or Parquet) files",
     )
     parser.add_argument(
         "--threshold",
@@ -261,6 +586,29 @@ def main() -> None:
         default=0.04,
         help="Minimum prevalence threshold for inclusion in the LaTeX table (default: 0.04 = 4%%)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Summarize up to N languages in parallel processes (default: one per language, up to the CPU count; "
+        "1 = in this process)",
+    )
+    parser.add_argument(
+        "--cooccurrence",
+        action="store_true",
+        help="Also emit method co-occurrence comments and a conditional co-occurrence table per language",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Re-aggregate every file instead of reusing <language>.summary.json from an unchanged source",
+    )
+    parser.add_argument(
+        "--sampled",
+        action="store_true",
+        help="Summarize the <language>.sample.csv (or .parquet) results of analyze.py --sample instead of the "
+        "full results",
+    )
     args = parser.parse_args()
 
     input_dir = args.directory
@@ -269,13 +617,27 @@ def main() -> None:
 
     per_language = {}
     missing_files = []
+    found_files = {}
 
     for filename in LANGUAGE_FILE_ORDER:
-        csv_path = input_dir / filename
+        csv_path = find_language_file(input_dir, filename, args.sampled)
         if not csv_path.exists():
             missing_files.append(filename)
             continue
-        per_language[filename] = analyze_language(csv_path)
+        found_files[filename] = csv_path
+
+    stale = {}
+    for filename, csv_path in found_files.items():
+        cached = None if args.no_cache else load_cached_summary(csv_path, args.cooccurrence)
+        if cached is None:
+            stale[filename] = csv_path
+        else:
+            per_language[filename] = cached
+
+    for filename, result in zip(stale, analyze_languages(list(stale.values()), args.workers, args.cooccurrence)):
+        per_language[filename] = result
+        if not args.no_cache:
+            write_cached_summary(stale[filename], result)
 
     if missing_files:
         print("% Warning: the following expected files were not found:")
@@ -293,6 +655,15 @@ def main() -> None:
     # Then: LaTeX table
     print(emit_latex_table(per_language, LANGUAGE_FILE_ORDER, threshold=args.threshold))
 
+    if args.cooccurrence:
+        for filename in LANGUAGE_FILE_ORDER:
+            if filename not in per_language:
+                continue
+            print()
+            print(emit_cooccurrence_comments(per_language[filename]))
+            print()
+            print(emit_cooccurrence_table(per_language[filename], Path(filename).stem, threshold=args.threshold))
+
 
 if __name__ == "__main__":
     main()
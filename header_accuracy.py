@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Measure how much analyze.py --header-region changes the results compared to
+scanning whole files, on a random sample of the local Parquet files.
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from typing import Dict, List, Optional, Pattern, Sequence, Set, Tuple
+
+import analyze
+
+
+def collect_sample(
+    languages: Sequence[str], parquet_files: Sequence[str], sample_files: int, seed: int, batch_size: int
+) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Up to sample_files (repo_name, content) pairs per language, taken from
+    row groups in random order.
+    """
+    units = analyze.list_scan_units(parquet_files)
+    random.Random(seed).shuffle(units)
+    extension_map = analyze.build_extension_map(languages)
+    filter_expression = analyze.scan_filter_expression(extension_map)
+
+    sample: Dict[str, List[Tuple[str, str]]] = {language: [] for language in languages}
+    for unit in units:
+        for batch in analyze.iter_unit_batches(unit, batch_size, filter_expression):
+            for language, repo_name, _, text in analyze.iter_source_files(batch, extension_map):
+                if len(sample[language]) < sample_files:
+                    sample[language].append((repo_name, text))
+        if all(len(files) >= sample_files for files in sample.values()):
+            break
+    return sample
+
+
+def match_sample(
+    files: Sequence[Tuple[str, str]],
+    compiled_patterns: Sequence[Tuple[str, Pattern[str]]],
+    limit: Optional[int],
+    end_pattern: Optional[Pattern[str]],
+) -> Tuple[List[Set[str]], float, int]:
+    """
+    Matched methods per file, seconds spent and characters scanned, for the
+    whole file (limit None) or its header region.
+    """
+    matches: List[Set[str]] = []
+    scanned = 0
+    start = time.perf_counter()
+    for _, text in files:
+        region = text if limit is None else analyze.header_region(text, limit, end_pattern)
+        scanned += len(region)
+        matches.append({method for method, cre in compiled_patterns if cre.search(region)})
+    return matches, time.perf_counter() - start, scanned
+
+
+def repo_presence(files: Sequence[Tuple[str, str]], matches: Sequence[Set[str]]) -> Dict[str, Set[str]]:
+    presence: Dict[str, Set[str]] = {}
+    for (repo_name, _), methods in zip(files, matches):
+        presence.setdefault(repo_name, set()).update(methods)
+    return presence
+
+
+def report_language(
+    language: str, files: Sequence[Tuple[str, str]], header_sizes: Sequence[Optional[int]]
+) -> List[str]:
+    compiled_patterns = analyze.compile_patterns(language)
+    end_source = analyze.HEADER_END_PATTERNS.get(language)
+    end_pattern = re.compile(end_source) if end_source else None
+
+    full_matches, full_seconds, full_chars = match_sample(files, compiled_patterns, None, None)
+    full_repos = repo_presence(files, full_matches)
+    full_any = {repo for repo, methods in full_repos.items() if methods}
+
+    lines = [f"== {language}: {len(files):,} files from {len(full_repos):,} repos =="]
+    lines.append(f"full file: {full_seconds:.2f}s, {full_chars / 1e6:.1f} M chars, {len(full_any):,} repos with any method")
+
+    for size in header_sizes:
+        limit = size or analyze.HEADER_REGION_BYTES[language]
+        matches, seconds, chars = match_sample(files, compiled_patterns, limit, end_pattern)
+        repos = repo_presence(files, matches)
+        any_method = {repo for repo, methods in repos.items() if methods}
+        speedup = full_seconds / seconds if seconds else float("inf")
+        lines.append("")
+        lines.append(
+            f"header {limit} bytes: {seconds:.2f}s ({speedup:.1f}x), {chars / 1e6:.1f} M chars, "
+            f"{len(any_method):,} repos with any method ({len(full_any - any_method):,} lost)"
+        )
+        lines.append(f"  {'method':<32} {'files full':>10} {'missed':>8} {'repos full':>10} {'missed':>8} {'recall':>7}")
+        for method, _ in compiled_patterns:
+            files_full = sum(method in found for found in full_matches)
+            files_missed = sum(method in full and method not in header for full, header in zip(full_matches, matches))
+            repos_full = sum(method in found for found in full_repos.values())
+            repos_missed = sum(method in full_repos[repo] and method not in repos[repo] for repo in full_repos)
+            if files_full == 0:
+                continue
+            recall = 1.0 - repos_missed / repos_full if repos_full else 1.0
+            lines.append(
+                f"  {method:<32} {files_full:>10,} {files_missed:>8,} {repos_full:>10,} {repos_missed:>8,} {recall:>7.1%}"
+            )
+    return lines
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Compare header-region matching with full-file matching on a sample of the dataset."
+    )
+    parser.add_argument("languages", nargs="+", help="Language name(s), or 'all'")
+    parser.add_argument("--data-files", default="data/train-0*-of-01126.parquet", help="Glob for local parquet files")
+    parser.add_argument("--sample-files", type=int, default=20000, help="Files to sample per language")
+    parser.add_argument(
+        "--header-bytes",
+        type=int,
+        nargs="*",
+        default=[0],
+        help="Header sizes to compare (0 = the per-language default in analyze.HEADER_REGION_BYTES)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for choosing row groups")
+    parser.add_argument("--batch-size", type=int, default=8192, help="Arrow batch size")
+    args = parser.parse_args()
+
+    try:
+        languages = analyze.resolve_languages(args.languages)
+    except ValueError as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+
+    parquet_files = analyze.iter_parquet_files(args.data_files)
+    if not parquet_files:
+        print(f"Error: no parquet files matched: {args.data_files}", file=sys.stderr)
+        return 1
+
+    sample = collect_sample(languages, parquet_files, args.sample_files, args.seed, args.batch_size)
+    for language in languages:
+        if not sample[language]:
+            print(f"== {language}: no files in the sample ==")
+            continue
+        print("\n".join(report_language(language, sample[language], args.header_bytes)))
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Combine the partial results of analyze.py --shard i/N runs into the final
+<language>.csv (or <language>.parquet) files in the current directory.
+"""
+
+import argparse
+import sys
+
+import analyze
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Merge analyze.py --shard partial results into per-language results.")
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Directories holding the <language>.shard-i-of-N.json manifests and their partials, or manifest files",
+    )
+    parser.add_argument(
+        "--languages",
+        nargs="+",
+        default=None,
+        help="Language name(s) to merge, or 'all' (default: every language with manifests)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=analyze.OUTPUT_FORMATS,
+        default="csv",
+        help="Write <language>.csv or a <language>.parquet directory",
+    )
+    parser.add_argument("--spill-dir", default=".", help="Where to keep the temporary sorted runs of the merge")
+    parser.add_argument(
+        "--flush-repos",
+        type=int,
+        default=100000,
+        help="Repos held in memory before they are spilled to a sorted run",
+    )
+    args = parser.parse_args()
+
+    try:
+        manifests = analyze.read_shard_manifests(args.inputs)
+    except (OSError, ValueError, KeyError) as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+    if not manifests:
+        print(f"Error: no shard manifests found in: {', '.join(args.inputs)}", file=sys.stderr)
+        return 1
+
+    try:
+        languages = analyze.resolve_languages(args.languages) if args.languages else list(manifests)
+    except ValueError as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+    missing = [language for language in languages if language not in manifests]
+    if missing:
+        print(f"Error: no shard manifests for: {', '.join(missing)}", file=sys.stderr)
+        return 1
+
+    for language in languages:
+        try:
+            analyze.check_shard_manifests(language, manifests[language])
+        except (ValueError, KeyError) as exc:
+            print(f"Error: {exc}", file=sys.stderr)
+            return 1
+
+    for language in languages:
+        scan = analyze.merge_shard_results(
+            language, manifests[language], args.output_format, args.spill_dir, args.flush_repos
+        )
+        shards = len(manifests[language])
+        print(f"END: Merged {shards} shards into {scan.output_path} ({scan.count:,} files).")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
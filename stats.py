@@ -0,0 +1,26 @@
+"""
+Statistics shared by analyze.py and create_summaries.py.
+"""
+from __future__ import annotations
+
+import math
+from typing import Tuple
+
+
+def wilson_ci(k: int, n: int, z: float = 1.96) -> Tuple[float, float]:
+    """
+    Wilson score interval for a binomial proportion.
+    Returns (lower, upper) as proportions in [0, 1].
+    """
+    if n == 0:
+        return (0.0, 0.0)
+
+    phat = k / n
+    denom = 1.0 + (z * z) / n
+    center = (phat + (z * z) / (2.0 * n)) / denom
+    margin = (
+        z
+        * math.sqrt((phat * (1.0 - phat) / n) + ((z * z) / (4.0 * n * n)))
+        / denom
+    )
+    return (max(0.0, center - margin), min(1.0, center + margin))